@@ -1,9 +1,7 @@
 import logging
 
-from threading import Thread
-
 from modules.bot import SenderBot, TelegramBot
-from modules.db import Database
+from modules.db import AsyncDatabase, Database
 from modules.utils import load_config
 
 
@@ -17,10 +15,15 @@ if __name__ == '__main__':
 
     # Database init
     db = Database()
-    db_conn = db.create_connection(check_same_thread=False)  # only telegram_bot writes data
-    db.create_table(db_conn, sql=db.sql_create_users_table)
+    db_conn = db.create_connection()
+    db.migrate(db_conn)
+    db_conn.close()
+    # one access path for handlers and reminders: per-thread connections of AsyncDatabase
+    async_db = AsyncDatabase(db)
 
-    sender_bot = SenderBot(config['TELEGRAM']['api_token'], db, db_conn)
-    Thread(target=sender_bot.run, daemon=True).start()
-    telegram_bot = TelegramBot(config['TELEGRAM']['api_token'])
+    # reminders run in the Application event loop and send through its Bot
+    telegram_bot = TelegramBot(config['TELEGRAM']['api_token'], config=config, db=async_db)
+    telegram_bot.sender_bot = SenderBot(
+        config['TELEGRAM']['api_token'], async_db, config=config,
+        bot=telegram_bot.application.bot)
     telegram_bot.run()
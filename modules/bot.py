@@ -3,13 +3,13 @@ import re
 import html
 import json
 import logging
+import signal
 import traceback
 
 
-from datetime import datetime
-from time import sleep
+from datetime import date, datetime, timedelta
+from time import monotonic
 from telegram import (
-    Bot,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardRemove,
@@ -25,42 +25,55 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from telegram.error import BadRequest
+from telegram.error import NetworkError, RetryAfter
 
+from .cache import LRUCache
+from .digest import BatchBuffer, ReviewDigest
+from .export import EXPORT_FORMATS, date_range, export_parts
+from .locks import UserSerialApplication
+from .scheduler import JobScheduler
+from .sender import MessageDispatcher, is_chat_unreachable, is_permanent_error, retry_delay
+from .sheets import SheetClient, SheetDiff, SheetSync
+from .throttle import UpdateThrottle
 from .users import User, UserRole, build_user
 from .utils import (
     load_config,
-    load_json,
     handle_error,
-    update_json_file,
-    get_datetime_passed_seconds,
-    slice_sheet_dates,
-    format_cleaning_date,
-    gspread_connect_save_users,
+    compile_clean_time,
 )
-from modules.db import Database
+from .webhook import WebhookServer
+from modules.db import AsyncDatabase, Database
 
 
 class SenderBot:
-    def __init__(self, api_token: str, db, db_conn, config=None):
+    """Напоминания об отзывах: расписание из таблицы и отправка по времени
+       Работает в event loop приложения PTB через его `bot` и общий AsyncDatabase
+    """
+
+    def __init__(self, api_token: str, db: AsyncDatabase, config=None, bot=None):
         self.api_token = api_token
         self.db = db
-        self.db_conn = db_conn
-        self.jobs_path = 'assets/task_jobs.json'
+        self.running = False
+        self.scheduler = JobScheduler()
+        self.schedule_dirty = True
+        self.sheet_diffs = []  # sheet changes waiting for main_loop, see apply_sheet_diffs
+        self.users_index = None
+        self.sheet_sync = SheetSync()
+        self.sheet_client = SheetClient()
+        self.sync_interval = 200  # seconds between gspread syncs
+        self.sync_timeout = 60  # seconds before a sheet sync counts as failed
+        self.sync_max_backoff = 3600  # max seconds between failed sheet syncs
+        self.retry_delay = 10  # base seconds of the delivery retry backoff
+        self.retry_max_delay = 3600
+        self.retry_max_attempts = 8
+        self.rebuild_retry_delay = 5  # base seconds between failed schedule rebuilds
+        # uids whose chats rejected delivery (blocked/deleted); no jobs until expiry or /start
+        self.unreachable = LRUCache(maxsize=100_000, ttl=7 * 24 * 3600)
+        self.dispatcher = MessageDispatcher(api_token, bot=bot, close_bot=bot is None)
 
     async def raw_send_message(self, chat_id, msg):
-        """Raw api send_message: asyncio.run(raw_send_message())"""
-        async with Bot(self.api_token) as bot:
-            await bot.send_message(chat_id, msg)
-
-    def get_task_jobs(self) -> list[dict]:
-        """Получить задачи или создать пустой файл"""
-        try:
-            jobs = load_json(self.jobs_path)
-        except FileNotFoundError:
-            update_json_file([], self.jobs_path)
-            jobs = load_json(self.jobs_path)
-        return jobs
+        """Отправить сообщение через общий MessageDispatcher (одна сессия Bot)"""
+        await self.dispatcher.send(chat_id, msg)
 
     def build_task_job(self, user: User, date: str) -> dict:
         """Создать объект задачи"""
@@ -72,82 +85,288 @@ class SenderBot:
         }
         return job
 
-    def build_task_jobs(self, users: dict, users_db: list[User]) -> list[dict]:
-        """Создать задачи, если юзер в таблице и в базе данных бота"""
+    @staticmethod
+    def build_users_index(users_db: list[User]) -> dict[int, list[User]]:
+        """Индекс phone_num -> пользователи бота с этим номером"""
+        users_index = {}
+        for user_db in users_db:
+            users_index.setdefault(user_db.phone_num, []).append(user_db)
+        return users_index
+
+    def build_task_jobs(
+            self, users: dict, users_index: dict[int, list[User]], today: date = None
+    ) -> list[dict]:
+        """Создать задачи, если юзер в таблице и в базе данных бота
+           Пользователи из `unreachable` пропускаются
+        """
+        today = today if today else datetime.today().date()
         jobs = []
         for user in users:
-            date = slice_sheet_dates(user['clean_time'])
-            date = format_cleaning_date(date)
-            if not date:
+            users_db = users_index.get(user['phone_num'])
+            if not users_db:
+                continue
+            schedule = compile_clean_time(user['clean_time'])
+            job_at = schedule.job_at(today) if schedule else None
+            if not job_at:
                 continue
             for user_db in users_db:
-                if user['phone_num'] == user_db.phone_num:
-                    job = self.build_task_job(user_db, date)
-                    jobs.append(job)
+                if user_db.uid in self.unreachable:
+                    continue
+                jobs.append(self.build_task_job(user_db, job_at))
         return jobs
 
-    def run(self):
-        """Берем пользователей из базы данных и таблицы
-           Создаем новые задачи build_task_jobs
-           Проверяем, если нет задач, добавить новые
-           Проверяем, если задача отправлена(sent),
-             Проверяем текущий день/удаляем из задач
-           Проверяем количество секунд до задачи
-             Если < 0, отправляем сообщение в телеграм
-                Обновляем sent=True
-           Обновляем файл задач
+    async def get_users_index(self) -> dict[int, list[User]]:
+        """Индекс пользователей бота; перестраивается только после изменения users"""
+        if self.users_index is None:
+            self.users_index = self.build_users_index(await self.db.get_users())
+        return self.users_index
+
+    @staticmethod
+    def today_range() -> tuple[str, str]:
+        today = datetime.today().date()
+        return f'{today} 00:00:00', f'{today} 23:59:59'
+
+    async def build_schedule(self) -> None:
+        """Пересобрать неотправленные задачи на сегодня в таблице jobs
+           Отправленные задачи (sent=1) сохраняются, в планировщик идут только неотправленные
+        """
+        users = list(self.sheet_sync.customers.values())
+        day_start, day_end = self.today_range()
+        jobs = self.build_task_jobs(users, await self.get_users_index())
+        await self.db.replace_pending_jobs(jobs, day_start, day_end)
+        self.scheduler.replace(await self.db.get_due_jobs(day_start, day_end))
+
+    async def apply_sheet_diff(self, diff: SheetDiff) -> None:
+        """Пересобрать задачи только клиентов, изменившихся в таблице"""
+        if self.schedule_dirty:  # полная пересборка и так впереди
+            return
+        users_index = await self.get_users_index()
+        uids = {
+            user.uid for phone_num in diff.phone_nums
+            for user in users_index.get(phone_num, [])
+        }
+        if not uids:
+            return
+        day_start, day_end = self.today_range()
+        # all current rows of the touched phones: a phone may have several adresses
+        phone_nums = diff.phone_nums
+        customers = [
+            customer for customer in self.sheet_sync.customers.values()
+            if customer['phone_num'] in phone_nums
+        ]
+        jobs = self.build_task_jobs(customers, users_index)
+        await self.db.replace_pending_jobs(jobs, day_start, day_end, uids=uids)
+        self.scheduler.discard(uids)
+        for job in await self.db.get_due_jobs(day_start, day_end, uids=uids):
+            self.scheduler.push(job)
+
+    async def apply_sheet_diffs(self) -> None:
+        """Применить накопленные изменения таблицы; вызывается только из main_loop
+           между пачками отправки, чтобы не пересоздать задачу, которая сейчас отправляется
+        """
+        while self.sheet_diffs:
+            await self.apply_sheet_diff(self.sheet_diffs.pop(0))
+
+    def chat_reachable(self, uid: int) -> None:
+        """Пользователь снова написал боту: снять подавление и вернуть его задачи"""
+        if self.unreachable.pop(uid) is not None:
+            self.reschedule()
+
+    def reschedule(self, users_changed=False) -> None:
+        """Пометить расписание устаревшим и разбудить цикл отправки
+           `users_changed` - пользователи бота изменились, сбросить индекс
+        """
+        if users_changed:
+            self.users_index = None
+        self.schedule_dirty = True
+        self.scheduler.notify()
+
+    async def send_task(self, task: dict) -> None:
+        """Отправить напоминание
+           Чат недоступен - задача закрывается с ошибкой, пользователь подавляется,
+           прочие BadRequest только закрывают задачу,
+           временные ошибки повторяются с backoff, см. `retry_task`
+        """
+        try:
+            print('- Sending message to:', task['uid'])
+            msg = [
+                'Если вы хотите оставить отзыв.',
+                'Вызовите команду - /review',
+            ]
+            msg = '\n'.join(msg)
+            await self.raw_send_message(task['uid'], msg)
+        except Exception as e:
+            if is_permanent_error(e):
+                logging.warning(f'Reminder to {task["uid"]} not deliverable: {e!r}')
+                if is_chat_unreachable(e):
+                    self.unreachable.set(task['uid'], repr(e))
+                else:
+                    handle_error(e, to_file=True)  # the request itself is wrong
+                await self.db.mark_job_failed(task['id'], repr(e))
+                return
+            if not isinstance(e, (NetworkError, RetryAfter)):
+                handle_error(e, to_file=True)
+            await self.retry_task(task, e)
+            return
+        await self.db.mark_job_sent(task['id'])
+
+    async def retry_task(self, task: dict, error: Exception) -> None:
+        """Запланировать повтор; время попытки хранится в jobs и переживает перезапуск
+           После `retry_max_attempts` попыток задача закрывается с ошибкой
         """
-        main_looop_delay = 10
-        i = 0
+        attempts = task.get('attempts', 0) + 1
+        if attempts > self.retry_max_attempts:
+            logging.warning(f'Reminder to {task["uid"]} failed after {attempts - 1} retries')
+            await self.db.mark_job_failed(task['id'], repr(error))
+            return
+        delay = retry_delay(error, attempts, self.retry_delay, self.retry_max_delay)
+        due = datetime.now() + timedelta(seconds=delay)
+        retry_at = due.strftime(self.scheduler.date_fmt)
+        await self.db.schedule_job_retry(task['id'], retry_at, repr(error))
+        self.scheduler.push(dict(task, attempts=attempts, retry_at=retry_at), due=due)
+
+    def fetch_sheet_diff(self) -> SheetDiff:
+        """Синхронизировать таблицу (блокирующий вызов, выполняется в потоке)"""
+        try:
+            return self.sheet_sync.sync(self.sheet_client.iter_rows())
+        except Exception:
+            self.sheet_client.reset()
+            raise
+
+    async def sync_sheet_loop(self) -> None:
+        """Фоновая синхронизация таблицы раз в `sync_interval` секунд
+           Зависший запрос не блокирует напоминания: каждые `sync_timeout` секунд
+           пишем предупреждение и продолжаем ждать его же; ошибки удваивают
+           `sync_interval` до `sync_max_backoff`, поэтому сбойный API опрашивается реже
+        """
+        failures = 0
+        timeouts = 0
+        task = None
         while True:
+            if task is None:
+                task = asyncio.ensure_future(asyncio.to_thread(self.fetch_sheet_diff))
             try:
-                if not i % 20:
-                    gspread_connect_save_users()  # update gspread users
-                    i = 1
-                users = load_json('assets/users.json')
-                users_db = [User(*user) for user in self.db.get_objects_all(self.db_conn, 'users')]
-                current_tasks = self.get_task_jobs()
-                new_tasks = self.build_task_jobs(users, users_db)
-                # если нет задач, добавить новые задачи
-                if not current_tasks:
-                    if new_tasks:
-                        update_json_file(new_tasks, file_path=self.jobs_path)
-                        current_tasks = self.get_task_jobs()
-                # проверить таски по времени / отправить сообщение в тг / задать sent=True
-                for i, task in enumerate(current_tasks):
-                    if task['sent']:
-                        # проверить если наступил новый день
-                        today = str(datetime.today().date())
-                        if today not in task['job_at']:
-                            del current_tasks[i]
-                        continue
-                    # сколько секунд до задачи
-                    until_task = get_datetime_passed_seconds(task['job_at'], reverse=True)
-                    if until_task < 0:
-                        try:
-                            print('- Sending message to:', task['uid'])
-                            msg = [
-                                'Если вы хотите оставить отзыв.',
-                                'Вызовите команду - /review',
-                            ]
-                            msg = '\n'.join(msg)
-                            asyncio.run(self.raw_send_message(task['uid'], msg))
-                        except BadRequest:
-                            print('- Chat not found')
-                        task['sent'] = True
-                update_json_file(current_tasks, file_path=self.jobs_path)
-                i += 1
+                diff = await asyncio.wait_for(asyncio.shield(task), self.sync_timeout)
+                task = None
+                failures = timeouts = 0
+                if diff:
+                    logging.info(
+                        'Sheet sync: +%s ~%s -%s', len(diff.inserted),
+                        len(diff.updated), len(diff.deleted))
+                    await self.db.replace_customers(
+                        diff.inserted + diff.updated, deleted=diff.deleted)
+                    self.sheet_diffs.append(diff)
+                    self.scheduler.notify()
+            except asyncio.TimeoutError:
+                timeouts += 1
+                logging.warning('Sheet sync is still running after %s timeouts', timeouts)
+                continue  # the wait itself took sync_timeout
             except Exception as e:
+                task = None
+                failures += 1
+                timeouts = 0
                 handle_error(e, to_file=True)
-            sleep(main_looop_delay)
+            delay = min(self.sync_interval * 2 ** failures, self.sync_max_backoff)
+            await asyncio.sleep(delay)
+
+    async def main_loop(self) -> None:
+        """Пересобираем расписание при изменении данных или смене дня
+           Отправляем задачи, время которых наступило
+           Спим до ближайшей задачи/полуночи; выходим после `stop`, дождавшись отправки
+           Неудачная пересборка повторяется с backoff, расписание остается помеченным
+        """
+        day = datetime.today().date()
+        rebuild_failures = 0
+        while self.running:
+            try:
+                if datetime.today().date() != day:
+                    day = datetime.today().date()
+                    await self.db.delete_jobs_before(f'{day} 00:00:00')
+                    self.schedule_dirty = True
+                if self.schedule_dirty:
+                    self.schedule_dirty = False
+                    self.sheet_diffs.clear()  # the full rebuild covers them
+                    try:
+                        await self.build_schedule()
+                    except Exception:
+                        self.schedule_dirty = True
+                        rebuild_failures += 1
+                        raise
+                    rebuild_failures = 0
+                await self.apply_sheet_diffs()
+                due_tasks = self.scheduler.pop_due()
+                if due_tasks:
+                    started = monotonic()
+                    await asyncio.gather(*(self.send_task(task) for task in due_tasks))
+                    elapsed = monotonic() - started
+                    logging.info(
+                        'Sent %s reminders in %.2fs (%.1f msg/s), dispatcher: %s',
+                        len(due_tasks), elapsed, len(due_tasks) / (elapsed or 1),
+                        self.dispatcher.stats)
+            except Exception as e:
+                handle_error(e, to_file=True)
+            now = datetime.now()
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            timeout = (midnight - now).total_seconds()
+            if rebuild_failures:
+                timeout = min(
+                    self.rebuild_retry_delay * 2 ** (rebuild_failures - 1),
+                    self.retry_max_delay, timeout)
+            if self.running:
+                await self.scheduler.wait(timeout=timeout)
+
+    async def run(self) -> None:
+        """Цикл напоминаний; запускается задачей в event loop приложения"""
+        self.running = True
+        # customers table starts from the last saved sheet snapshot
+        await self.db.replace_customers(list(self.sheet_sync.customers.values()))
+        async with self.dispatcher:
+            sync_task = asyncio.create_task(self.sync_sheet_loop())
+            try:
+                await self.main_loop()
+            finally:
+                sync_task.cancel()
+                await asyncio.gather(sync_task, return_exceptions=True)
+
+    def stop(self) -> None:
+        """Не брать новые задачи; `run` завершится после отправки текущих"""
+        self.running = False
+        self.scheduler.notify()
 
 
 class TelegramBot:
-    def __init__(self, api_token: str, config=None):
+    def __init__(
+            self, api_token: str, config=None, sender_bot: SenderBot = None,
+            db: AsyncDatabase = None):
         self.api_token = api_token
         self.config = config if config else load_config()
-        self.db = Database()
-        self.db_conn = self.db.create_connection()
+        self.sender_bot = sender_bot
+        self.db = db if db else AsyncDatabase(Database())
+        self.review_digest = None
+        # reviews are written to db in batches, off the handler path
+        self.review_writer = BatchBuffer(self.save_reviews, max_size=50, interval=5)
+        self.webhook = None
+        self.throttle = UpdateThrottle(
+            rate=self.config['TELEGRAM'].getfloat('throttle_rate', fallback=1),
+            capacity=self.config['TELEGRAM'].getfloat('throttle_capacity', fallback=5),
+        )
+        self.application = self.build_application()
+
+    def build_review_digest(self, bot) -> None:
+        """Включить сводки отзывов для менеджеров, если они включены в конфиге"""
+        section = self.config['TELEGRAM']
+        if not section.getboolean('review_digest', fallback=False):
+            return
+        self.review_digest = ReviewDigest(
+            lambda text: self.notify_managers(bot, text),
+            max_size=section.getint('review_digest_size', fallback=20),
+            interval=section.getfloat('review_digest_interval', fallback=3600),
+        )
+
+    def users_changed(self) -> None:
+        """Сообщить SenderBot, что состав пользователей изменился"""
+        if self.sender_bot:
+            self.sender_bot.reschedule(users_changed=True)
 
     @property
     def auth_invalid_msg(self) -> str:
@@ -156,8 +375,10 @@ class TelegramBot:
     async def command_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Инициировать аутентификацию пользователя"""
         user_id = update.effective_user.id
+        if self.sender_bot:
+            self.sender_bot.chat_reachable(user_id)
         try:
-            user = self.db.get_user(self.db_conn, user_id)
+            user = await self.db.get_user(user_id)
             msg = [
                 f'Здравствуйте, {user.full_name}',
                 'Если вы хотите оставить отзыв',
@@ -193,13 +414,12 @@ class TelegramBot:
             msg = f'Здравствуйте, {user["full_name"]}\nВаша роль менеджер'
             await update.message.reply_text(msg)
             user = build_user(user, update.effective_user, manager=True)
-            self.db.insert_user(self.db_conn, user)
+            await self.db.insert_user(user)
             return ConversationHandler.END
         # Проверка длины номера / поиск в пользователях
         if phone_len == num_limit:
             try:
-                users = load_json('assets/users.json')
-                user = [user for user in users if user['phone_num'] == int(phone)][0]
+                user = await self.db.get_customer(int(phone))
                 msg = [
                     f'Здравствуйте, {user["full_name"]}',
                     'Вы можете оценить качество наших услуг по шкале:',
@@ -214,7 +434,8 @@ class TelegramBot:
                 await update.message.reply_text(msg)
                 # insert user to db
                 user = build_user(user, update.effective_user)
-                self.db.insert_user(self.db_conn, user)
+                await self.db.insert_user(user)
+                self.users_changed()
                 # end conversation
                 return ConversationHandler.END
             except IndexError:
@@ -229,7 +450,7 @@ class TelegramBot:
     async def command_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Помошник для вывода команд"""
         try:
-            self.db.get_user(self.db_conn, update.effective_user.id)
+            await self.db.get_user(update.effective_user.id)
             msg = [
                 '<b>Доступные команды:</b>',
                 '/start - Аутентификацию по номеру телефона',
@@ -237,6 +458,8 @@ class TelegramBot:
                 '/unsub - Отписаться от рассылки',
                 '/role - Изменение роли',
                 '/review - Оставить отзыв',
+                '/stats - Статистика отзывов (для менеджеров)',
+                '/export - Выгрузка отзывов (для менеджеров)',
                 '/cancel - Прервать диалог',
             ]
             msg = '\n'.join(msg)
@@ -247,8 +470,10 @@ class TelegramBot:
     async def command_unsub(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Удалить пользователя из базы данных"""
         try:
-            user = self.db.get_user(self.db_conn, update.effective_user.id)
-            self.db.delete_object(self.db_conn, 'users', 'uid', user.uid)
+            user = await self.db.get_user(update.effective_user.id)
+            await self.db.delete_object('users', 'uid', user.uid)
+            await self.db.delete_object('jobs', 'uid', user.uid)
+            self.users_changed()
             msg = 'Вы были удалены из базы данных бота.'
             await update.message.reply_text(msg)
             return ConversationHandler.END
@@ -258,7 +483,7 @@ class TelegramBot:
     async def command_review(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Создать клавиатуру для оценки от -2 до +2"""
         try:
-            user = self.db.get_user(self.db_conn, update.effective_user.id)
+            user = await self.db.get_user(update.effective_user.id)
             msg = 'Оцените качество услуги:'
             score_range = ['-2', '-1', '0', '+1', '+2']
             score_btns = [
@@ -283,8 +508,10 @@ class TelegramBot:
         return 2
 
     async def review_comment(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """Принятие комментария пользователя и завершения диалога"""
-        managers = self.db.get_managers(self.db_conn)
+        """Принятие комментария пользователя и завершения диалога
+           Отзыв отправляется менеджерам в фоне, ответ пользователю не ждет доставки
+           В режиме сводок отзыв буферизуется, негативные оценки уходят сразу
+        """
         user = context.user_data['user']
         score = context.user_data['review_score']
         comment = update.message.text.replace('/skip', '')
@@ -292,24 +519,119 @@ class TelegramBot:
         review_msg = [
             '<b>Отзыв пользователя:</b>',
             f'<b>ID:</b> {user.uid}',
-            f'<b>ФИО:</b> {user.full_name}',
+            f'<b>ФИО:</b> {html.escape(user.full_name)}',
             f'<b>Номер телефон:</b> {user.phone_num}',
             f'<b>Оценка:</b> {score}',
-            f'<b>Комментарий:</b> {comment}',
+            f'<b>Комментарий:</b> {html.escape(comment)}',
         ]
         await update.message.reply_text(msg)
-        for manager in managers:
-            await context.bot.send_message(
-                chat_id=manager.uid,
-                text='\n'.join(review_msg),
-                parse_mode=ParseMode.HTML,
-            )
+        review = {
+            'uid': user.uid,
+            'phone_num': user.phone_num,
+            'score': int(score),
+            'comment': comment,
+            'created': str(datetime.now()),
+        }
+        context.application.create_task(self.review_writer.add(review), update=update)
+        if self.review_digest:
+            notify = self.review_digest.add('\n'.join(review_msg), urgent=score in ('-2', '-1'))
+        else:
+            notify = self.notify_managers(context.bot, '\n'.join(review_msg))
+        context.application.create_task(notify, update=update)
         return ConversationHandler.END
 
+    async def notify_managers(self, bot, text: str) -> None:
+        """Разослать сообщение всем менеджерам параллельно
+           Ошибка доставки одному менеджеру не мешает остальным
+        """
+        managers = await self.db.get_managers()
+        results = await asyncio.gather(*(
+            bot.send_message(chat_id=manager.uid, text=text, parse_mode=ParseMode.HTML)
+            for manager in managers
+        ), return_exceptions=True)
+        for manager, result in zip(managers, results):
+            if isinstance(result, Exception):
+                logging.warning(f'Review not delivered to manager {manager.uid}: {result!r}')
+
+    async def save_reviews(self, reviews: list[dict]) -> None:
+        await self.db.insert_reviews(reviews)
+
+    async def check_manager(self, update: Update) -> bool:
+        """Пользователь - менеджер; иначе ответить, почему команда недоступна"""
+        try:
+            user = await self.db.get_user(update.effective_user.id)
+        except IndexError:
+            await update.message.reply_text(self.auth_invalid_msg)
+            return False
+        if user.role != UserRole.MANAGER:
+            await update.message.reply_text('Команда доступна только менеджерам.')
+            return False
+        return True
+
+    async def command_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Статистика отзывов для менеджеров: всего, сегодня, за 7 дней
+           `/stats <номер телефона>` - по клиенту; читаются только готовые агрегаты
+        """
+        if not await self.check_manager(update):
+            return
+        await self.review_writer.flush()
+        today = date.today()
+        week_ago = today - timedelta(days=6)
+        periods = [
+            ('Всего', ('total',)),
+            ('Сегодня', ('day', str(today))),
+            ('За 7 дней', ('day', str(week_ago), str(today))),
+        ]
+        if context.args:
+            phone_num = context.args[0]
+            periods.append((f'Клиент {html.escape(phone_num)}', ('customer', phone_num)))
+        msg = ['<b>Статистика отзывов:</b>']
+        for title, args in periods:
+            stats = await self.db.get_review_stats(*args)
+            msg.append(
+                f'<b>{title}:</b> {stats["reviews"]}, средняя оценка {stats["avg_score"]}, '
+                f'негативных {stats["negative"]}')
+        await update.message.reply_text('\n'.join(msg), parse_mode=ParseMode.HTML)
+
+    async def command_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Выгрузка отзывов файлами: `/export [csv|jsonl] [с YYYY-mm-dd] [по YYYY-mm-dd]`
+           Строки идут потоком через отдельное соединение, база не блокируется;
+           большая выгрузка делится на части, каждая отправляется, как только заполнится
+        """
+        if not await self.check_manager(update):
+            return
+        args = list(context.args or [])
+        fmt = args.pop(0) if args and args[0] in EXPORT_FORMATS else 'csv'
+        date_from, date_to = (args + [None, None])[:2]
+        try:
+            date_range(date_from, date_to)
+        except ValueError:
+            await update.message.reply_text(
+                'Формат: /export [csv|jsonl] [с YYYY-mm-dd] [по YYYY-mm-dd]')
+            return
+        await self.review_writer.flush()
+        loop = asyncio.get_running_loop()
+
+        def export() -> tuple[int, int]:
+            # one thread owns the read connection; each part is uploaded before the next
+            total = 0
+            parts = export_parts(
+                self.db.db, self.db.connections.db_file, fmt, date_from, date_to)
+            for part, (fp, count) in enumerate(parts, 1):
+                upload = update.message.reply_document(
+                    fp, filename=f'reviews-{part}.{fmt}',
+                    caption=f'Часть {part}, отзывов: {count}')
+                asyncio.run_coroutine_threadsafe(upload, loop).result()
+                total += count
+            return total, part
+
+        total, parts = await asyncio.to_thread(export)
+        await update.message.reply_text(f'Выгружено отзывов: {total}, файлов: {parts}')
+
     async def command_role(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Изменение роли пользователя"""
         try:
-            self.db.get_user(self.db_conn, update.effective_user.id)  # validate user
+            await self.db.get_user(update.effective_user.id)  # validate user
             role_btns = [
                 InlineKeyboardButton(role.value, callback_data=role.value) for role in UserRole]
             reply_keyboard = [role_btns]
@@ -335,8 +657,7 @@ class TelegramBot:
         else:
             msg = f'Ваша роль изменена на [{query.data}]'
             await query.edit_message_text(text=msg)
-            self.db.update_object(
-                self.db_conn, 'users', 'role', 'uid', (new_role, user_id))
+            await self.db.update_object('users', 'role', 'uid', (new_role, user_id))
             return ConversationHandler.END
 
     async def role_change_password(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -345,8 +666,7 @@ class TelegramBot:
         if password == self.config['TELEGRAM']['manager_password']:
             user_id = update.effective_user.id
             new_role = context.user_data['role_change']
-            self.db.update_object(
-                self.db_conn, 'users', 'role', 'uid', (new_role, user_id))
+            await self.db.update_object('users', 'role', 'uid', (new_role, user_id))
             msg = f'Ваша роль изменена на [{new_role}]'
             await update.message.reply_text(msg)
             return ConversationHandler.END
@@ -390,10 +710,30 @@ class TelegramBot:
             parse_mode=ParseMode.HTML
         )
 
-    def run(self):
-        """Запустить бота"""
+    def build_application(self) -> Application:
+        """Создать Application с обработчиками команд"""
         # Create the Application and pass it your bot's token.
-        application = Application.builder().token(self.api_token).build()
+        # updates of different users run concurrently, of one user - in order
+        builder = Application.builder().token(self.api_token).application_class(
+            UserSerialApplication).concurrent_updates(
+            self.config['TELEGRAM'].getint('concurrent_updates', fallback=64))
+        webhook = self.config['WEBHOOK'] if self.config.has_section('WEBHOOK') else None
+        use_webhook = webhook and webhook.getboolean('enabled', fallback=False)
+        if use_webhook:
+            builder.update_queue(asyncio.Queue(maxsize=webhook.getint('queue_size', 1000)))
+        application = builder.build()
+        # flood control runs before an update is queued for its user
+        application.throttle = self.throttle
+        if use_webhook:
+            self.webhook = WebhookServer(
+                application.update_queue, application.bot,
+                listen=webhook.get('listen', '127.0.0.1'),
+                port=webhook.getint('port', 8443),
+                url_path=webhook.get('url_path', 'telegram'),
+                secret_token=webhook.get('secret_token', ''),
+                read_timeout=webhook.getfloat('read_timeout', 10),
+            )
+        self.build_review_digest(application.bot)
         # start conversation
         start_conv_handler = ConversationHandler(
             entry_points=[CommandHandler('start', self.command_start)],
@@ -427,10 +767,62 @@ class TelegramBot:
         application.add_handler(start_conv_handler)
         application.add_handler(CommandHandler('help', self.command_help))
         application.add_handler(CommandHandler('unsub', self.command_unsub))
+        application.add_handler(CommandHandler('stats', self.command_stats))
+        application.add_handler(CommandHandler('export', self.command_export))
         application.add_handler(role_conv_handler)
         # application.add_handler(upload_conv_handler)
         application.add_handler(review_conv_handler)
         # ...and the error handler
         application.add_error_handler(self.error_handler)
-        # Run the bot until the user presses Ctrl-C
-        application.run_polling()
+        return application
+
+    def run(self):
+        """Запустить бота и цикл напоминаний в одном event loop до SIGINT/SIGTERM"""
+        try:
+            asyncio.run(self.run_async())
+        finally:
+            self.db.close()
+
+    async def run_async(self, stop: asyncio.Event = None) -> None:
+        """Принимать обновления и отправлять напоминания, пока не установлен `stop`"""
+        stop = stop if stop else asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        async with self.application:
+            await self.start_updates()
+            await self.application.start()
+            sender_task = None
+            if self.sender_bot:
+                sender_task = asyncio.create_task(self.sender_bot.run())
+            try:
+                await stop.wait()
+            finally:
+                await self.shutdown(sender_task)
+
+    async def start_updates(self) -> None:
+        """Получать обновления через webhook (если включен в конфиге) или long polling"""
+        if not self.webhook:
+            await self.application.updater.start_polling()
+            return
+        await self.webhook.start()
+        webhook_url = self.config['WEBHOOK'].get('webhook_url')
+        if webhook_url:
+            await self.application.bot.set_webhook(
+                webhook_url, api_kwargs={'secret_token': self.webhook.secret_token})
+
+    async def shutdown(self, sender_task: asyncio.Task = None) -> None:
+        """Остановить прием обновлений и дождаться начатых отправок и записей"""
+        if self.webhook:
+            await self.webhook.stop()
+        else:
+            await self.application.updater.stop()
+        if sender_task:
+            self.sender_bot.stop()
+            await asyncio.gather(sender_task, return_exceptions=True)
+        await self.application.stop()  # pending updates and create_task tasks
+        if self.review_digest:
+            await self.review_digest.flush()
+        await self.review_writer.flush()
+        logging.info('Throttle: %s', self.throttle.stats)
+        logging.info('Users cache: %s', self.db.db.users_cache.stats)
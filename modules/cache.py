@@ -0,0 +1,69 @@
+import threading
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """Ограниченный LRU кэш с временем жизни записей (TTL)
+       Потокобезопасный; считает попадания и промахи
+    """
+
+    def __init__(self, maxsize=1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            item = self.data.get(key)
+            return bool(item) and item[0] > monotonic()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item and item[0] > monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item:
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float = None) -> None:
+        ttl = ttl if ttl is not None else self.ttl
+        with self.lock:
+            self.data[key] = (monotonic() + ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+            return item[1] if item else default
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hit_rate, 3),
+        }
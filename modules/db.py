@@ -1,13 +1,29 @@
+import asyncio
 import logging
 import sqlite3
+import threading
 
-from .users import User
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Iterator
+
+from .cache import LRUCache
+from .users import User, UserRole, user_row_factory
 from .utils import load_config, handle_error
 
 
 class Database:
-    def __init__(self, config=''):
+    pragmas = {
+        'journal_mode': 'WAL',  # readers do not block the writer
+        'synchronous': 'NORMAL',  # fsync on checkpoint, not on every commit
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,  # KiB
+        'busy_timeout': 5000,  # ms
+    }
+
+    def __init__(self, config='', users_cache_size=1024, users_cache_ttl=300):
         self.config = config if config else load_config()
+        self.users_cache = LRUCache(maxsize=users_cache_size, ttl=users_cache_ttl)
         self.sql_create_users_table = """
             CREATE TABLE IF NOT EXISTS users (
                 uid integer PRIMARY KEY,
@@ -19,17 +35,149 @@ class Database:
                 created text NOT NULL,
                 updated text NOT NULL
             );"""
+        self.sql_create_jobs_table = """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id integer PRIMARY KEY,
+                uid integer NOT NULL,
+                phone_num int NOT NULL,
+                job_at text NOT NULL,
+                sent boolean NOT NULL DEFAULT 0,
+                UNIQUE (uid, job_at)
+            );"""
+        self.sql_create_customers_table = """
+            CREATE TABLE IF NOT EXISTS customers (
+                phone_num integer NOT NULL,
+                adress text NOT NULL,
+                full_name text NOT NULL,
+                clean_time text NOT NULL,
+                PRIMARY KEY (phone_num, adress)
+            ) WITHOUT ROWID;"""
+        # delivery retries: `attempts` so far, next try at `retry_at`, last `error`
+        # permanently failed jobs are sent=1 with an error
+        self.sql_alter_jobs_retry = [
+            'ALTER TABLE jobs ADD COLUMN attempts integer NOT NULL DEFAULT 0;',
+            'ALTER TABLE jobs ADD COLUMN retry_at text;',
+            'ALTER TABLE jobs ADD COLUMN error text;',
+        ]
+        self.sql_create_reviews_table = """
+            CREATE TABLE IF NOT EXISTS reviews (
+                id integer PRIMARY KEY,
+                uid integer NOT NULL,
+                phone_num int NOT NULL,
+                adress text,
+                score integer NOT NULL,
+                comment text NOT NULL,
+                created text NOT NULL
+            );"""
+        # rolling aggregates: scope 'total' (key ''), 'customer' (phone_num),
+        # 'adress' and 'day' (YYYY-mm-dd); kept up to date by reviews_stats trigger
+        self.sql_create_review_stats_table = """
+            CREATE TABLE IF NOT EXISTS review_stats (
+                scope text NOT NULL,
+                key text NOT NULL,
+                reviews integer NOT NULL,
+                score_sum integer NOT NULL,
+                negative integer NOT NULL,
+                PRIMARY KEY (scope, key)
+            ) WITHOUT ROWID;"""
+        self.sql_create_reviews_trigger = """
+            CREATE TRIGGER IF NOT EXISTS reviews_stats AFTER INSERT ON reviews
+            BEGIN
+                INSERT INTO review_stats (scope, key, reviews, score_sum, negative)
+                SELECT scope, key, 1, NEW.score, NEW.score < 0 FROM (
+                    SELECT 'total' AS scope, '' AS key
+                    UNION ALL SELECT 'customer', NEW.phone_num
+                    UNION ALL SELECT 'day', substr(NEW.created, 1, 10)
+                    UNION ALL SELECT 'adress', NEW.adress
+                ) WHERE key IS NOT NULL
+                ON CONFLICT (scope, key) DO UPDATE SET
+                    reviews = reviews + excluded.reviews,
+                    score_sum = score_sum + excluded.score_sum,
+                    negative = negative + excluded.negative;
+            END;"""
+        self.sql_create_jobs_indexes = [
+            'CREATE INDEX IF NOT EXISTS jobs_sent_job_at ON jobs (sent, job_at);',
+            'CREATE INDEX IF NOT EXISTS jobs_uid ON jobs (uid);',
+        ]
+        # schema versions, applied in order by `migrate`; append only
+        self.migrations = [
+            [
+                self.sql_create_users_table,
+                self.sql_create_jobs_table,
+                *self.sql_create_jobs_indexes,
+                # v1 customers, keyed by phone_num; rebuilt by migration 6
+                """CREATE TABLE IF NOT EXISTS customers (
+                    phone_num integer PRIMARY KEY,
+                    adress text NOT NULL,
+                    full_name text NOT NULL,
+                    clean_time text NOT NULL
+                );""",
+            ],
+            [
+                'CREATE INDEX IF NOT EXISTS users_role ON users (role);',
+                'CREATE INDEX IF NOT EXISTS users_phone_num ON users (phone_num);',
+            ],
+            [
+                self.sql_create_reviews_table,
+                self.sql_create_review_stats_table,
+                self.sql_create_reviews_trigger,
+            ],
+            [
+                'CREATE INDEX IF NOT EXISTS reviews_created ON reviews (created);',
+            ],
+            self.sql_alter_jobs_retry,
+            [
+                # customers keyed by sheet row (phone_num, adress), not phone_num alone
+                'ALTER TABLE customers RENAME TO customers_v5;',
+                self.sql_create_customers_table,
+                """INSERT OR REPLACE INTO customers (phone_num, adress, full_name, clean_time)
+                   SELECT phone_num, adress, full_name, clean_time FROM customers_v5;""",
+                'DROP TABLE customers_v5;',
+            ],
+            [
+                # per-user job queries filter on all three columns, no INDEXED BY needed
+                'DROP INDEX IF EXISTS jobs_uid;',
+                'CREATE INDEX IF NOT EXISTS jobs_uid_sent_job_at ON jobs (uid, sent, job_at);',
+            ],
+        ]
 
     def create_connection(self, db_file='db.sqlite3', check_same_thread=True):
         """Connect to db/Create `db.sqlite3` in root folder if not exist"""
         conn = None
         try:
             conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
+            self.apply_pragmas(conn)
             logging.info('Connected to db\n')
         except Exception as e:
             handle_error(e)
         return conn
 
+    def apply_pragmas(self, conn) -> None:
+        """Apply `self.pragmas` to connection"""
+        cur = conn.cursor()
+        for pragma, value in self.pragmas.items():
+            cur.execute(f'PRAGMA {pragma}={value}')
+
+    def migrate(self, conn) -> int:
+        """Apply `self.migrations` newer than `PRAGMA user_version`
+           Each version runs in its own transaction; returns the schema version
+        """
+        cur = conn.cursor()
+        version = cur.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(self.migrations[version:], start=version + 1):
+            try:
+                cur.execute('BEGIN')
+                for sql in statements:
+                    cur.execute(sql)
+                cur.execute(f'PRAGMA user_version={number}')
+                conn.commit()
+                logging.info(f'Migrated db to version {number}')
+            except Exception as e:
+                conn.rollback()
+                handle_error(e)
+            version = number
+        return version
+
     def create_table(self, conn, sql):
         """Create project table from `self.sql_create_project_table`
            Optional `sql` kwarg if you want to create new table
@@ -42,13 +190,28 @@ class Database:
             handle_error(e)
 
     def insert_object(self, conn, table: str, fields: tuple, values: tuple):
+        """Insert table object, values are bound as parameters"""
+        try:
+            cur = conn.cursor()
+            cur.execute(self.sql_insert(table, fields), values)
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def insert_objects(self, conn, table: str, fields: tuple, rows: list[tuple]):
+        """Bulk insert in one transaction"""
         try:
             cur = conn.cursor()
-            cur.execute(f'INSERT OR IGNORE INTO {table} {fields} VALUES {values}')
+            cur.executemany(self.sql_insert(table, fields), rows)
             conn.commit()
         except Exception as e:
             handle_error(e)
 
+    @staticmethod
+    def sql_insert(table: str, fields: tuple) -> str:
+        placeholders = ', '.join('?' * len(fields))
+        return f'INSERT OR IGNORE INTO {table} ({", ".join(fields)}) VALUES ({placeholders})'
+
     def update_object(self, conn, table: str, column: str, field: str, values: tuple):
         """Update table object, filtered by field value
            update_object(db_conn, db_table, 'test_text', 'test_bool', ('changed', 1)
@@ -59,44 +222,182 @@ class Database:
             conn.commit()
         except Exception as e:
             handle_error(e)
+        finally:
+            self.invalidate_users(table, field, values[1])
+
+    def update_objects(self, conn, table: str, column: str, field: str, rows: list[tuple]):
+        """Bulk update_object in one transaction, rows of (column value, field value)"""
+        try:
+            cur = conn.cursor()
+            cur.executemany(f'UPDATE {table} SET {column}=? WHERE {field}=?', rows)
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+        finally:
+            for row in rows:
+                self.invalidate_users(table, field, row[1])
 
     def delete_object(self, conn, table: str, field: str, value):
         """Delete table object"""
         try:
             cur = conn.cursor()
-            cur.execute(f'DELETE FROM {table} WHERE {field}={value}')
+            cur.execute(f'DELETE FROM {table} WHERE {field}=?', (value,))
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+        finally:
+            self.invalidate_users(table, field, value)
+
+    def delete_objects(self, conn, table: str, field: str, values: list):
+        """Bulk delete in one transaction"""
+        try:
+            cur = conn.cursor()
+            cur.executemany(f'DELETE FROM {table} WHERE {field}=?', [(v,) for v in values])
             conn.commit()
         except Exception as e:
             handle_error(e)
+        finally:
+            for value in values:
+                self.invalidate_users(table, field, value)
+
+    def invalidate_users(self, table: str, field: str, value) -> None:
+        """Drop cached users touched by a write to `table` filtered by `field`"""
+        if table != 'users':
+            return
+        if field == 'uid':
+            self.users_cache.pop(int(value))
+        else:
+            self.users_cache.clear()
 
     def insert_user(self, conn, user: User) -> None:
         """Insert user into users from User keys/values"""
-        keys = tuple(user.__dict__.keys())
-        values = tuple(user.__dict__.values())
-        self.insert_object(conn, 'users', keys, values)
+        self.insert_object(conn, 'users', User.field_names(), user.to_row())
+        self.users_cache.pop(user.uid)
+
+    def insert_users(self, conn, users: list[User]) -> None:
+        """Bulk insert_user in one transaction"""
+        rows = [user.to_row() for user in users]
+        self.insert_objects(conn, 'users', User.field_names(), rows)
+        for user in users:
+            self.users_cache.pop(user.uid)
+
+    def replace_customers(self, conn, customers: list[dict], deleted=None) -> None:
+        """Upsert sheet customers and delete `deleted` customer rows in one transaction
+           Without `deleted` the table is replaced by `customers` entirely
+        """
+        try:
+            cur = conn.cursor()
+            if deleted is None:
+                cur.execute('DELETE FROM customers')
+            else:
+                cur.executemany(
+                    'DELETE FROM customers WHERE phone_num=? AND adress=?',
+                    [(c['phone_num'], c['adress']) for c in deleted])
+            cur.executemany(
+                """INSERT OR REPLACE INTO customers (phone_num, adress, full_name, clean_time)
+                   VALUES (?, ?, ?, ?)""",
+                [(c['phone_num'], c['adress'], c['full_name'], c['clean_time'])
+                 for c in customers])
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def get_customer(self, conn, phone_num: int) -> dict:
+        """Sheet customer by phone_num (primary key prefix); IndexError if not found
+           A phone with several adresses returns the first row
+        """
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT phone_num, adress, full_name, clean_time FROM customers WHERE phone_num=?',
+            (phone_num,))
+        row = cur.fetchall()[0]
+        return dict(zip(('phone_num', 'adress', 'full_name', 'clean_time'), row))
+
+    def insert_reviews(self, conn, reviews: list[dict]) -> None:
+        """Bulk insert reviews in one transaction, `review_stats` is updated by trigger
+           review keys: uid, phone_num, score, comment, created and optional adress;
+           without adress it is taken from customers only if the phone has a single adress,
+           otherwise NULL, so per-adress stats are never attributed to a wrong flat
+        """
+        try:
+            cur = conn.cursor()
+            cur.executemany(
+                """INSERT INTO reviews (uid, phone_num, adress, score, comment, created)
+                   VALUES (?, ?, coalesce(?, (
+                       SELECT CASE WHEN count(*) = 1 THEN max(adress) END
+                       FROM customers WHERE phone_num=?)), ?, ?, ?)""",
+                [(r['uid'], r['phone_num'], r.get('adress'), r['phone_num'], r['score'],
+                  r['comment'], r['created']) for r in reviews])
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def iter_reviews(
+            self, conn, created_from='', created_to='9999', batch_size=1000) -> Iterator[tuple]:
+        """Reviews with created in [created_from, created_to) ordered by created
+           Rows are fetched `batch_size` at a time; use a separate connection,
+           under WAL the open read does not block writers
+        """
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT id, uid, phone_num, adress, score, comment, created FROM reviews
+               WHERE created >= ? AND created < ? ORDER BY created""",
+            (created_from, created_to))
+        while rows := cur.fetchmany(batch_size):
+            yield from rows
+
+    def get_review_stats(self, conn, scope: str, key_from='', key_to=None) -> dict:
+        """Summed aggregates of `scope` keys in [key_from, key_to] (primary key range)
+           get_review_stats(conn, 'total')
+           get_review_stats(conn, 'day', '2022-09-01', '2022-09-07')
+        """
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT coalesce(sum(reviews), 0), coalesce(sum(score_sum), 0),
+                      coalesce(sum(negative), 0)
+               FROM review_stats WHERE scope=? AND key BETWEEN ? AND ?""",
+            (scope, str(key_from), str(key_from if key_to is None else key_to)))
+        reviews, score_sum, negative = cur.fetchone()
+        return {
+            'reviews': reviews,
+            'negative': negative,
+            'avg_score': round(score_sum / reviews, 2) if reviews else 0.0,
+        }
 
     def get_user(self, conn, user_id) -> User:
-        user = self.get_objects_filter_by_value(conn, 'users', 'uid', user_id)[0]
-        return User(*user)
+        """User by uid through `users_cache`; IndexError if not found"""
+        user = self.users_cache.get(user_id)
+        if user is None:
+            user = self.get_objects_filter_by_value(
+                conn, 'users', 'uid', user_id, row_factory=user_row_factory)[0]
+            self.users_cache.set(user_id, user)
+        return user
+
+    def get_users(self, conn) -> list[User]:
+        return self.get_objects_all(conn, 'users', row_factory=user_row_factory)
 
     def get_managers(self, conn) -> list[User]:
-        users = self.get_objects_filter_by_value(conn, 'users', 'role', 'Менеджер')
-        users = [User(*user) for user in users]
-        return users
+        return self.get_objects_filter_by_value(
+            conn, 'users', 'role', UserRole.MANAGER.value, row_factory=user_row_factory)
 
-    def get_objects_all(self, conn, table: str) -> list:
-        """Return queryset of table objects"""
+    def get_objects_all(self, conn, table: str, row_factory=None) -> list:
+        """Return queryset of table objects
+           `row_factory` - applied to this cursor only, e.g. `user_row_factory`
+        """
         try:
             cur = conn.cursor()
+            cur.row_factory = row_factory
             cur.execute(f'SELECT * FROM {table}')
             return cur.fetchall()
         except Exception as e:
             handle_error(e)
 
-    def get_objects_filter_by_value(self, conn, table: str, column: str, value) -> list:
+    def get_objects_filter_by_value(
+            self, conn, table: str, column: str, value, row_factory=None) -> list:
         """Filter db table by column value"""
         try:
             cur = conn.cursor()
+            cur.row_factory = row_factory
             cur.execute(f'SELECT * FROM {table} WHERE {column}=?', (value,))
             return cur.fetchall()
         except Exception as e:
@@ -105,9 +406,154 @@ class Database:
     def get_objects_field_values(self, conn, table: str, column: str) -> list:
         """Select column values from table"""
         try:
-            conn.row_factory = lambda cursor, row: row[0]
             cur = conn.cursor()
+            cur.row_factory = lambda cursor, row: row[0]
             cur.execute(f'SELECT {column} FROM {table}')
             return cur.fetchall()
         except Exception as e:
             handle_error(e)
+
+    def replace_pending_jobs(
+            self, conn, jobs: list[dict], job_at_from: str, job_at_to: str, uids=None):
+        """Replace unsent jobs in [job_at_from, job_at_to] range
+           Sent rows and rows waiting for a retry (retry_at set) are kept
+           `uids` - replace only jobs of these users ((uid, sent, job_at) index)
+        """
+        try:
+            cur = conn.cursor()
+            if uids is None:
+                cur.execute(
+                    '''DELETE FROM jobs
+                       WHERE sent=0 AND job_at BETWEEN ? AND ? AND retry_at IS NULL''',
+                    (job_at_from, job_at_to))
+            else:
+                cur.executemany(
+                    '''DELETE FROM jobs
+                       WHERE uid=? AND sent=0 AND job_at BETWEEN ? AND ? AND retry_at IS NULL''',
+                    [(uid, job_at_from, job_at_to) for uid in uids])
+            cur.executemany(
+                'INSERT OR IGNORE INTO jobs (uid, phone_num, job_at, sent) VALUES (?, ?, ?, ?)',
+                [(job['uid'], job['phone_num'], job['job_at'], job['sent']) for job in jobs])
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def get_due_jobs(self, conn, job_at_from: str, job_at_to: str, uids=None) -> list[dict]:
+        """Unsent jobs with job_at in range, uses (sent, job_at) index
+           `uids` - only jobs of these users ((uid, sent, job_at) index)
+        """
+        try:
+            cur = conn.cursor()
+            sql = 'SELECT id, uid, phone_num, job_at, sent, attempts, retry_at FROM jobs'
+            if uids is None:
+                cur.execute(
+                    f'{sql} WHERE sent=0 AND job_at BETWEEN ? AND ? ORDER BY job_at',
+                    (job_at_from, job_at_to))
+                rows = cur.fetchall()
+            else:
+                rows = []
+                for uid in uids:
+                    cur.execute(
+                        f'''{sql}
+                            WHERE uid=? AND sent=0 AND job_at BETWEEN ? AND ?''',
+                        (uid, job_at_from, job_at_to))
+                    rows += cur.fetchall()
+            fields = ('id', 'uid', 'phone_num', 'job_at', 'sent', 'attempts', 'retry_at')
+            return [dict(zip(fields, row)) for row in rows]
+        except Exception as e:
+            handle_error(e)
+
+    def mark_job_sent(self, conn, job_id: int) -> None:
+        try:
+            cur = conn.cursor()
+            cur.execute('UPDATE jobs SET sent=1 WHERE id=?', (job_id,))
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def mark_job_failed(self, conn, job_id: int, error: str) -> None:
+        """Permanent delivery failure: the job leaves the pending queue with its error"""
+        try:
+            cur = conn.cursor()
+            cur.execute('UPDATE jobs SET sent=1, error=? WHERE id=?', (error, job_id))
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def schedule_job_retry(self, conn, job_id: int, retry_at: str, error: str) -> None:
+        """Transient delivery failure: count the attempt and persist the next try time"""
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                'UPDATE jobs SET attempts=attempts+1, retry_at=?, error=? WHERE id=?',
+                (retry_at, error, job_id))
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+    def delete_jobs_before(self, conn, job_at: str) -> None:
+        """Delete jobs of previous days"""
+        try:
+            cur = conn.cursor()
+            cur.execute('DELETE FROM jobs WHERE job_at<?', (job_at,))
+            conn.commit()
+        except Exception as e:
+            handle_error(e)
+
+
+class ConnectionManager:
+    """One sqlite connection per thread, created on first use with Database pragmas"""
+
+    def __init__(self, db: Database, db_file='db.sqlite3'):
+        self.db = db
+        self.db_file = db_file
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get(self):
+        """Connection of the current thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # closed from another thread by close_all, only the owner thread uses it
+            conn = self.local.conn = self.db.create_connection(
+                self.db_file, check_same_thread=False)
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close_all(self) -> None:
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class AsyncDatabase:
+    """Awaitable facade over Database for async handlers
+       Same methods as Database without the `conn` argument:
+       `await adb.get_user(uid)` instead of `db.get_user(conn, uid)`
+       Queries run on a thread pool, each worker thread owns its connection
+    """
+
+    def __init__(self, db: Database, db_file='db.sqlite3', workers=4, connections=None):
+        self.db = db
+        self.connections = connections if connections else ConnectionManager(db, db_file)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+
+    def call(self, method, *args, **kwargs):
+        return method(self.connections.get(), *args, **kwargs)
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+
+        async def run_in_executor(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, partial(self.call, method, *args, **kwargs))
+        return run_in_executor
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.connections.close_all()
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+
+from .utils import handle_error
+
+
+class BatchBuffer:
+    """Буфер, сбрасываемый пачкой
+       Элементы копятся и передаются в `handler` одним списком, когда набралось
+       `max_size` или с первого элемента прошло `interval` секунд
+       `handler` - корутина-функция, принимающая список элементов
+       Если `handler` упал, элементы возвращаются в буфер и повторяются через `interval`
+    """
+
+    def __init__(self, handler, max_size=100, interval: float = 1):
+        self.handler = handler
+        self.max_size = max_size
+        self.interval = interval
+        self.items = []
+        self.timer = None
+        self.failed = False  # last handler call failed, retry by timer only
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    async def add(self, item) -> None:
+        self.items.append(item)
+        if len(self.items) >= self.max_size and not self.failed:
+            await self.flush()
+        elif not self.timer:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(self.interval)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Передать накопленные элементы в `handler`"""
+        if self.timer and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+        self.timer = None
+        items, self.items = self.items, []
+        if not items:
+            return
+        try:
+            await self.handler(items)
+        except Exception as e:
+            # keep the items: the error goes to the log instead of an unobserved timer task
+            handle_error(e, to_file=True)
+            logging.warning(f'{type(self).__name__}: {len(items)} items kept for retry')
+            self.items[:0] = items
+            self.failed = True
+            if not self.timer:
+                self.timer = asyncio.create_task(self.flush_later())
+            return
+        self.failed = False
+
+
+class ReviewDigest(BatchBuffer):
+    """Буфер отзывов для менеджеров
+       Отзывы уходят одной сводкой по размеру или времени, срочные отправляются сразу
+       `send` - корутина-функция, рассылающая текст всем менеджерам
+    """
+    msg_limit = 4096  # telegram message length limit
+
+    def __init__(self, send, max_size=20, interval: float = 3600):
+        super().__init__(self.send_digest, max_size=max_size, interval=interval)
+        self.send = send
+        self.sent_messages = 0
+
+    async def add(self, review: str, urgent=False) -> None:
+        if urgent:
+            await self.deliver(review)
+        else:
+            await super().add(review)
+
+    async def send_digest(self, reviews: list[str]) -> None:
+        """Отправить отзывы одним (или несколькими при длине > 4096) сообщением"""
+        for text in self.build_messages(reviews):
+            await self.deliver(text)
+
+    async def deliver(self, text: str) -> None:
+        self.sent_messages += 1
+        await self.send(text)
+
+    def build_messages(self, reviews: list[str]) -> list[str]:
+        if not reviews:
+            return []
+        messages = []
+        current = f'<b>Сводка отзывов ({len(reviews)}):</b>'
+        for review in reviews:
+            if len(current) + len(review) + 2 > self.msg_limit:
+                messages.append(current)
+                current = review
+            else:
+                current = f'{current}\n\n{review}'
+        messages.append(current)
+        return messages
@@ -0,0 +1,135 @@
+import argparse
+import csv
+import io
+import json
+import tempfile
+
+from datetime import date, timedelta
+from typing import IO, Iterable, Iterator, Optional
+
+from .db import Database
+
+
+REVIEW_FIELDS = ('id', 'uid', 'phone_num', 'adress', 'score', 'comment', 'created')
+EXPORT_FORMATS = ('csv', 'jsonl')
+PART_MAX_BYTES = 20 * 1024 * 1024  # Bot API accepts documents up to 50 MB
+PART_MAX_ROWS = 200_000
+
+
+def iter_csv(rows: Iterable[tuple], chunk_size=64 * 1024) -> Iterator[str]:
+    """CSV с заголовком, текст отдается кусками примерно по `chunk_size` символов"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REVIEW_FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(rows: Iterable[tuple], chunk_size=64 * 1024) -> Iterator[str]:
+    """JSON Lines, одна строка на отзыв, куски примерно по `chunk_size` символов"""
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(REVIEW_FIELDS, row)), ensure_ascii=False) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+
+def date_range(date_from: Optional[str], date_to: Optional[str]) -> tuple[str, str]:
+    """Даты YYYY-mm-dd (включительно) -> полуинтервал `created` для Database.iter_reviews
+       ValueError при неверном формате даты
+    """
+    created_from = str(date.fromisoformat(date_from)) if date_from else ''
+    created_to = str(date.fromisoformat(date_to) + timedelta(days=1)) if date_to else '9999'
+    return created_from, created_to
+
+
+def export_reviews(
+        db: Database, db_file: str, fp: IO[bytes], fmt='csv',
+        date_from: str = None, date_to: str = None) -> int:
+    """Выгрузить отзывы в бинарный файл `fp` потоком, возвращает число строк
+       Читает через собственное соединение, в памяти только текущий кусок
+    """
+    created_from, created_to = date_range(date_from, date_to)
+    formatter = iter_jsonl if fmt == 'jsonl' else iter_csv
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    conn = db.create_connection(db_file)
+    try:
+        rows = db.iter_reviews(conn, created_from, created_to)
+        for chunk in formatter(counted(rows)):
+            fp.write(chunk.encode('utf-8'))
+    finally:
+        conn.close()
+    return count
+
+
+def export_parts(
+        db: Database, db_file: str, fmt='csv', date_from: str = None, date_to: str = None,
+        max_bytes=PART_MAX_BYTES, max_rows=PART_MAX_ROWS) -> Iterator[tuple[IO[bytes], int]]:
+    """Выгрузить отзывы частями: (файл, число строк) для каждой части
+       Часть заканчивается на `max_rows` строках или примерно `max_bytes` байтах
+       и отдается сразу; CSV-часть начинается с заголовка. Файл части открыт только
+       до перехода к следующей, поэтому в памяти не больше одной части
+    """
+    created_from, created_to = date_range(date_from, date_to)
+    formatter = iter_jsonl if fmt == 'jsonl' else iter_csv
+    chunk_size = min(64 * 1024, max_bytes)
+    conn = db.create_connection(db_file)
+    try:
+        rows = db.iter_reviews(conn, created_from, created_to)
+        row = next(rows, None)
+        while True:
+            count = 0
+            with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as fp:
+
+                def part_rows():
+                    nonlocal row, count
+                    while row is not None and count < max_rows and fp.tell() < max_bytes:
+                        yield row
+                        count += 1
+                        row = next(rows, None)
+
+                for chunk in formatter(part_rows(), chunk_size):
+                    fp.write(chunk.encode('utf-8'))
+                fp.seek(0)
+                yield fp, count
+            if row is None:
+                return
+    finally:
+        conn.close()
+
+
+def main(argv=None) -> None:
+    """python -m modules.export --format jsonl --from 2022-09-01 -o reviews.jsonl"""
+    parser = argparse.ArgumentParser(description='Выгрузка отзывов')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--from', dest='date_from', help='YYYY-mm-dd, включительно')
+    parser.add_argument('--to', dest='date_to', help='YYYY-mm-dd, включительно')
+    parser.add_argument('--db', default='db.sqlite3')
+    parser.add_argument('-o', '--output', required=True)
+    args = parser.parse_args(argv)
+    with open(args.output, 'wb') as fp:
+        count = export_reviews(
+            Database(), args.db, fp, args.format, args.date_from, args.date_to)
+    print(f'- Exported {count} reviews to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import logging
+
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.ext._application import _STOP_SIGNAL
+
+
+class UserSerialApplication(Application):
+    """Application с `concurrent_updates`: обновления разных пользователей
+       обрабатываются параллельно, одного пользователя - по очереди,
+       чтобы переходы состояний ConversationHandler оставались согласованными
+       У каждого uid своя очередь и одна задача, которая ее разбирает; семафор
+       `concurrent_updates` берется только на время обработки, поэтому ожидающие
+       обновления одного пользователя не занимают места других
+       `throttle` (UpdateThrottle) отбрасывает флуд до постановки в очередь
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.user_queues = {}  # key -> deque of updates, exists while its task runs
+        self.throttle = None
+
+    @staticmethod
+    def serial_key(update: object):
+        """uid (или chat id) обновления; None - обрабатывать без очереди"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def _update_fetcher(self) -> None:
+        while True:
+            update = await self.update_queue.get()
+            if update is _STOP_SIGNAL:
+                logging.debug('Dropping pending updates')
+                while not self.update_queue.empty():
+                    self.update_queue.task_done()
+                self.update_queue.task_done()
+                return
+            if self.throttled(update):
+                continue
+            if self.concurrent_updates:
+                self.dispatch_update(update)
+            else:
+                await self.handle_update(update)
+
+    def throttled(self, update: object) -> bool:
+        """Пользователь превысил лимит: обновление отбрасывается"""
+        key = self.serial_key(update)
+        if self.throttle is None or key is None or self.throttle.allow(key):
+            return False
+        self.update_queue.task_done()
+        self.create_task(self.throttle.reject(update), update=update)
+        return True
+
+    def dispatch_update(self, update: object) -> None:
+        """Поставить обновление в очередь его пользователя"""
+        key = self.serial_key(update)
+        if key is None:
+            self.create_task(self.handle_update(update), update=update)
+            return
+        queue = self.user_queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return
+        self.user_queues[key] = deque([update])
+        self.create_task(self.drain_user_queue(key))
+
+    async def drain_user_queue(self, key) -> None:
+        """Обработать обновления пользователя по порядку и удалить его очередь"""
+        queue = self.user_queues[key]
+        try:
+            while queue:
+                await self.handle_update(queue.popleft())
+        finally:
+            for _ in queue:  # cancelled on shutdown
+                self.update_queue.task_done()
+            del self.user_queues[key]
+
+    async def handle_update(self, update: object) -> None:
+        async with self._concurrent_updates_sem:
+            try:
+                await self.process_update(update)
+            finally:
+                self.update_queue.task_done()
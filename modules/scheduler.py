@@ -0,0 +1,86 @@
+import asyncio
+import heapq
+import itertools
+
+from datetime import datetime
+from typing import Optional
+
+
+class JobScheduler:
+    """Очередь задач на min-heap по времени `job_at` (или `retry_at` повторной попытки)
+       Спит до ближайшей задачи, просыпается сразу при изменении расписания
+    """
+    date_fmt = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self):
+        self._heap = []  # (due, seq, job)
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._loop = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _entry(self, job: dict, due: datetime = None) -> tuple:
+        due = due if due else datetime.strptime(
+            job.get('retry_at') or job['job_at'], self.date_fmt)
+        return (due, next(self._seq), job)
+
+    def push(self, job: dict, due: datetime = None) -> None:
+        """Добавить задачу и разбудить ожидающий цикл
+           `due` - переопределить время срабатывания (повторная попытка)
+        """
+        heapq.heappush(self._heap, self._entry(job, due))
+        self.notify()
+
+    def replace(self, jobs: list[dict]) -> None:
+        """Заменить расписание целиком"""
+        self._heap = [self._entry(job) for job in jobs]
+        heapq.heapify(self._heap)
+        self.notify()
+
+    def discard(self, uids: set) -> None:
+        """Убрать из очереди задачи пользователей `uids`"""
+        self._heap = [entry for entry in self._heap if entry[2]['uid'] not in uids]
+        heapq.heapify(self._heap)
+
+    def next_due(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime = None) -> list[dict]:
+        """Забрать из очереди все задачи, время которых наступило"""
+        now = now if now else datetime.now()
+        jobs = []
+        while self._heap and self._heap[0][0] <= now:
+            jobs.append(heapq.heappop(self._heap)[2])
+        return jobs
+
+    def notify(self) -> None:
+        """Разбудить `wait`; безопасно вызывать из другого потока"""
+        if self._loop and self._loop.is_running():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not self._loop:
+                self._loop.call_soon_threadsafe(self._changed.set)
+                return
+        self._changed.set()
+
+    async def wait(self, timeout: float = None, now: datetime = None) -> bool:
+        """Ждать ближайшую задачу, изменения расписания или `timeout` секунд
+           Возвращает True, если расписание изменилось
+        """
+        self._loop = asyncio.get_running_loop()
+        now = now if now else datetime.now()
+        delays = [timeout] if timeout is not None else []
+        due = self.next_due()
+        if due:
+            delays.append(max((due - now).total_seconds(), 0))
+        delay = min(delays) if delays else None
+        try:
+            await asyncio.wait_for(self._changed.wait(), delay)
+        except asyncio.TimeoutError:
+            return False
+        self._changed.clear()
+        return True
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import random
+
+from time import monotonic
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+
+
+UNREACHABLE_CHAT_MESSAGES = (
+    'chat not found', 'user not found', 'user is deactivated', 'peer_id_invalid',
+)
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """Ошибка, которую повтор не исправит: чат недоступен или запрос неверный"""
+    return isinstance(error, (BadRequest, Forbidden))
+
+
+def is_chat_unreachable(error: Exception) -> bool:
+    """Чат недоступен: бот заблокирован, чат не найден, аккаунт удален
+       Прочие BadRequest (ошибка в самом запросе) к пользователю не относятся
+    """
+    if isinstance(error, Forbidden):
+        return True
+    message = error.message.lower() if isinstance(error, BadRequest) else ''
+    return any(text in message for text in UNREACHABLE_CHAT_MESSAGES)
+
+
+def retry_delay(error: Exception, attempt: int, base: float = 10, cap: float = 3600) -> float:
+    """Пауза перед попыткой `attempt` (с 1): `RetryAfter` от API или
+       экспоненциальный backoff `base * 2 ** (attempt - 1)` до `cap` с jitter
+    """
+    if isinstance(error, RetryAfter):
+        return error.retry_after + random.uniform(0, 1)
+    delay = min(base * 2 ** (attempt - 1), cap)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    """Token bucket: `rate` токенов в секунду, не более `capacity` за раз"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity else rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def try_acquire(self) -> float:
+        """Взять токен; вернуть 0 или сколько секунд ждать следующего"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+class MessageDispatcher:
+    """Долгоживущая очередь отправки сообщений через один `Bot`
+       Воркеры отправляют параллельно в пределах лимитов Telegram:
+       `global_rate` сообщений/сек на бота и `chat_rate` сообщений/сек на чат
+       `close_bot=False` - сессией `bot` владеет другой (например, Application)
+    """
+
+    def __init__(
+            self, api_token: str = '', workers=8, global_rate=30, chat_rate=1, bot: Bot = None,
+            close_bot=True):
+        if bot is None:
+            bot = Bot(api_token, request=HTTPXRequest(connection_pool_size=workers))
+        self.bot = bot
+        self.close_bot = close_bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = {}
+        self.queue = None
+        self.tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.started_at = None
+
+    async def start(self) -> None:
+        """Инициализировать Bot (одна HTTP сессия) и запустить воркеры"""
+        if self.tasks:
+            return
+        await self.bot.initialize()
+        self.queue = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.started_at = monotonic()
+
+    async def stop(self) -> None:
+        """Дождаться отправки очереди, остановить воркеры и закрыть сессию"""
+        if not self.tasks:
+            return
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.close_bot:
+            await self.bot.shutdown()
+        logging.info('Dispatcher stopped: %s', self.stats)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+    def submit(self, chat_id, text: str, **kwargs) -> asyncio.Future:
+        """Поставить сообщение в очередь; Future завершится результатом send_message"""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((chat_id, text, kwargs, future))
+        return future
+
+    async def send(self, chat_id, text: str, **kwargs):
+        return await self.submit(chat_id, text, **kwargs)
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if not bucket:
+            if len(self.chat_buckets) > 10000:  # забыть простаивающие чаты
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items() if not value.full}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id, text, kwargs, future = await self.queue.get()
+            try:
+                await self.chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+                result = await self.bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    @property
+    def throughput(self) -> float:
+        """Отправлено сообщений в секунду с момента запуска"""
+        if not self.started_at:
+            return 0.0
+        elapsed = monotonic() - self.started_at
+        return self.sent / elapsed if elapsed else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'queued': self.queue.qsize() if self.queue else 0,
+            'msg_per_sec': round(self.throughput, 2),
+        }
@@ -0,0 +1,216 @@
+import gspread
+import hashlib
+import json
+import logging
+import re
+
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator
+
+from .utils import load_json, replace_json_file
+
+
+def parse_sheet_row(row: list[str]) -> dict:
+    """Строка таблицы (A-D) -> клиент; ValueError если номер телефона не число"""
+    return {
+        'adress': row[0],
+        'full_name': row[1],
+        'phone_num': int(row[2]),
+        'clean_time': str(row[3]),
+    }
+
+
+def customer_key(customer: dict) -> tuple[int, str]:
+    """Идентичность строки клиента: у одного телефона может быть несколько адресов"""
+    return customer['phone_num'], customer['adress']
+
+
+def customer_hash(customer: dict) -> str:
+    """Хэш содержимого клиента для сравнения строк между синхронизациями"""
+    data = '\x1f'.join(str(customer[key]) for key in (
+        'adress', 'full_name', 'phone_num', 'clean_time'))
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class SheetClient:
+    """Кэшированный клиент gspread
+       Авторизация и поиск листа выполняются один раз, токен обновляется
+       сессией google-auth только по истечении срока действия
+       Строки читаются постранично и только из нужных колонок
+    """
+
+    def __init__(
+            self, sheet_title='Таблица для сбора обратной связи', worksheet_title='Лист1',
+            filename='assets/service_account.json', columns=('A', 'D'), page_size=500):
+        self.sheet_title = sheet_title
+        self.worksheet_title = worksheet_title
+        self.filename = filename
+        self.columns = columns
+        self.page_size = page_size
+        self.client = None
+        self.worksheet = None
+
+    def get_worksheet(self):
+        if self.worksheet is None:
+            if self.client is None:
+                self.client = gspread.service_account(filename=self.filename)
+            self.worksheet = self.client.open(self.sheet_title).worksheet(self.worksheet_title)
+        return self.worksheet
+
+    def reset(self) -> None:
+        """Забыть лист (например, после ошибки API); клиент и токен сохраняются"""
+        self.worksheet = None
+
+    def iter_rows(self) -> Iterator[list[str]]:
+        """Строки листа по `page_size` за запрос, до конца сетки листа (`row_count`)
+           API отбрасывает пустые строки в конце диапазона, поэтому неполная страница
+           в середине листа (пустые строки на границе страниц) не означает конец данных
+        """
+        worksheet = self.get_worksheet()
+        first_col, last_col = self.columns
+        width = ord(last_col) - ord(first_col) + 1
+        start = 1
+        while True:
+            end = start + self.page_size - 1
+            rows = worksheet.get(f'{first_col}{start}:{last_col}{end}')
+            for row in rows:
+                yield list(row) + [''] * (width - len(row))
+            if end >= worksheet.row_count and len(rows) < self.page_size:
+                return
+            start = end + 1
+
+
+class FakeWorksheet:
+    """Локальная замена gspread.Worksheet для тестов без сети"""
+
+    def __init__(self, rows: list[list[str]], row_count: int = None):
+        self.rows = rows
+        self.grid_rows = row_count
+        self.fetches = 0
+
+    @property
+    def row_count(self) -> int:
+        """Число строк сетки листа, как Worksheet.row_count"""
+        return self.grid_rows if self.grid_rows is not None else len(self.rows)
+
+    def get_all_values(self) -> list[list[str]]:
+        self.fetches += 1
+        return [list(row) for row in self.rows]
+
+    def get(self, range_name: str) -> list[list[str]]:
+        """Диапазон вида `A1:D500`; пустые строки в конце отбрасываются, как в API"""
+        self.fetches += 1
+        first_col, start, last_col, end = re.fullmatch(
+            r'([A-Z])(\d+):([A-Z])(\d+)', range_name).groups()
+        cols = slice(ord(first_col) - ord('A'), ord(last_col) - ord('A') + 1)
+        rows = [list(row[cols]) for row in self.rows[int(start) - 1:int(end)]]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+
+@dataclass
+class SheetDiff:
+    inserted: list[dict] = field(default_factory=list)
+    updated: list[dict] = field(default_factory=list)
+    deleted: list[dict] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.inserted or self.updated or self.deleted)
+
+    @property
+    def phone_nums(self) -> set[int]:
+        """Номера телефонов всех затронутых клиентов"""
+        return {
+            customer['phone_num']
+            for customer in self.inserted + self.updated + self.deleted
+        }
+
+
+class SheetSync:
+    """Инкрементальная синхронизация клиентов из таблицы
+       Хранит хэш каждой строки и всего листа, возвращает SheetDiff
+       Файл `users_path` перезаписывается только при изменениях
+    """
+
+    def __init__(self, users_path='assets/users.json'):
+        self.users_path = users_path
+        self.customers = {}  # customer_key -> customer
+        self.hashes = {}  # customer_key -> customer_hash
+        self.sheet_hash = None
+        self.load()
+
+    def load(self) -> None:
+        """Заполнить состояние из сохраненного файла клиентов
+           Поврежденный файл пропускается: следующая синхронизация перезапишет его
+        """
+        try:
+            customers = load_json(self.users_path)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            logging.warning(f'Customers snapshot {self.users_path} is corrupt, skipped: {e}')
+            return
+        for customer in customers:
+            self.customers[customer_key(customer)] = customer
+            self.hashes[customer_key(customer)] = customer_hash(customer)
+
+    def diff(self, customers: list[dict]) -> SheetDiff:
+        """Строки с одинаковыми телефоном и адресом - одна строка, побеждает последняя"""
+        diff = SheetDiff()
+        hashes = {}
+        rows = {}
+        for customer in customers:
+            key = customer_key(customer)
+            if key in rows:
+                logging.warning(f'Duplicate sheet row {key}, the last one is used')
+            rows[key] = customer
+            hashes[key] = customer_hash(customer)
+        for key, customer in rows.items():
+            if key not in self.hashes:
+                diff.inserted.append(customer)
+            elif self.hashes[key] != hashes[key]:
+                diff.updated.append(customer)
+        diff.deleted = [
+            customer for key, customer in self.customers.items() if key not in hashes
+        ]
+        return diff
+
+    def apply(self, diff: SheetDiff) -> None:
+        """Опубликовать новый снимок клиентов заменой ссылок, без изменения текущего
+           Читатели `customers` всегда видят целый старый или целый новый снимок
+        """
+        customers, hashes = dict(self.customers), dict(self.hashes)
+        for customer in diff.deleted:
+            customers.pop(customer_key(customer), None)
+            hashes.pop(customer_key(customer), None)
+        for customer in diff.inserted + diff.updated:
+            customers[customer_key(customer)] = customer
+            hashes[customer_key(customer)] = customer_hash(customer)
+        self.hashes = hashes
+        self.customers = customers
+
+    def sync(self, rows: Iterable[list[str]]) -> SheetDiff:
+        """Прочитать строки листа (с заголовком) и вернуть изменения с прошлой синхронизации
+           Строки обрабатываются потоком, лист целиком в памяти не хранится
+        """
+        sheet_hash = hashlib.blake2b(digest_size=16)
+        customers = []
+        for i, row in enumerate(rows):
+            sheet_hash.update(repr(row).encode('utf-8'))
+            if not i or not any(row):  # header, blank row
+                continue
+            try:
+                customers.append(parse_sheet_row(row))
+            except ValueError as e:
+                logging.warning(f'Sheet row {i + 1} skipped: {e}')
+                continue
+        sheet_hash = sheet_hash.hexdigest()
+        if sheet_hash == self.sheet_hash:
+            return SheetDiff()
+        diff = self.diff(customers)
+        if diff:
+            self.apply(diff)
+            replace_json_file(list(self.customers.values()), file_path=self.users_path)
+        self.sheet_hash = sheet_hash
+        return diff
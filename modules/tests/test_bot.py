@@ -0,0 +1,343 @@
+import asyncio
+import os
+import pytest
+import sqlite3
+import tempfile
+
+from functools import partial
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime
+from time import perf_counter, sleep
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from .. import bot as bot_module
+from ..bot import SenderBot, TelegramBot
+from ..db import AsyncDatabase, Database
+from ..sheets import SheetDiff, customer_key
+from ..users import User
+from ..utils import load_config, slice_sheet_dates, format_cleaning_date
+from .test_sender import FakeBot
+
+
+def build_sheet_users(count: int) -> list[dict]:
+    return [
+        {
+            'adress': f'adress {i}',
+            'full_name': f'user {i}',
+            'phone_num': 89000000000 + i,
+            'clean_time': 'Ежедневно в 20:00',
+        } for i in range(count)
+    ]
+
+
+def build_db_users(count: int, step=1) -> list[User]:
+    return [
+        User(i, f'user{i}', f'user{i}', f'user {i}', 89000000000 + i,
+             'Пользователь', '', '') for i in range(0, count * step, step)
+    ]
+
+
+def build_task_jobs_nested(sender: SenderBot, users: list[dict], users_db: list[User]):
+    """Прежняя реализация: вложенный цикл таблица x база"""
+    jobs = []
+    for user in users:
+        date = format_cleaning_date(slice_sheet_dates(user['clean_time']))
+        if not date:
+            continue
+        for user_db in users_db:
+            if user['phone_num'] == user_db.phone_num:
+                jobs.append(sender.build_task_job(user_db, date))
+    return jobs
+
+
+class TestSenderBot(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db = Database()
+        self.async_db = AsyncDatabase(
+            self.db, os.path.join(self.tmp_dir.name, 'bot.sqlite3'), workers=2)
+        self.db_conn = self.async_db.connections.get()
+        self.db.migrate(self.db_conn)
+        self.sender = SenderBot('123:test', self.async_db, bot=FakeBot(delay=0))
+        self.sender.sheet_sync.users_path = os.path.join(self.tmp_dir.name, 'users.json')
+
+    def tearDown(self):
+        self.async_db.close()
+        self.tmp_dir.cleanup()
+
+    def test_build_task_jobs_index(self):
+        users = build_sheet_users(100)
+        users_db = build_db_users(20, step=3)
+        users_db.append(User(999, 'dup', 'dup', 'dup', users_db[0].phone_num, '', '', ''))
+        users_index = self.sender.build_users_index(users_db)
+        jobs = self.sender.build_task_jobs(users, users_index)
+        assert jobs == build_task_jobs_nested(self.sender, users, users_db)
+        assert len(jobs) == 21
+
+    def test_unreachable_chats_suppressed(self):
+        users = build_sheet_users(3)
+        users_index = self.sender.build_users_index(build_db_users(3))
+        self.sender.unreachable.set(1, 'Forbidden')
+        jobs = self.sender.build_task_jobs(users, users_index)
+        assert [job['uid'] for job in jobs] == [0, 2]
+        self.sender.schedule_dirty = False
+        self.sender.chat_reachable(1)
+        assert self.sender.schedule_dirty
+        assert len(self.sender.build_task_jobs(users, users_index)) == 3
+
+    def test_get_users_index_cached(self):
+        users_index = asyncio.run(self.sender.get_users_index())
+        assert asyncio.run(self.sender.get_users_index()) is users_index
+        self.sender.reschedule(users_changed=True)
+        assert asyncio.run(self.sender.get_users_index()) is not users_index
+
+    def test_apply_sheet_diff(self):
+        self.db.insert_users(self.db_conn, build_db_users(3))
+        customers = build_sheet_users(3)
+        # second adress of customer 0 with another cleaning time
+        customers.append(dict(customers[0], adress='adress 0b', clean_time='Ежедневно в 9:00'))
+        self.sender.sheet_sync.sync(
+            [['header']] + [[c['adress'], c['full_name'], c['phone_num'], c['clean_time']]
+                            for c in customers])
+        asyncio.run(self.sender.build_schedule())
+        self.sender.schedule_dirty = False
+        assert len(self.sender.scheduler) == 4  # both rows of the shared phone
+        updated = dict(customers[1], clean_time='Ежедневно в 21:00')
+        diff = SheetDiff(updated=[updated], deleted=[customers[2], customers[0]])
+        self.sender.sheet_sync.apply(diff)
+        asyncio.run(self.sender.apply_sheet_diff(diff))
+        jobs = sorted(self.sender.scheduler.pop_due(datetime.max), key=lambda job: job['uid'])
+        assert [job['uid'] for job in jobs] == [0, 1]
+        assert jobs[0]['job_at'].endswith('09:00:00')  # sibling row of phone 0 kept
+        assert jobs[1]['job_at'].endswith('21:00:00')
+
+    def test_sync_sheet_loop_timeout(self):
+        calls = []
+
+        def fetch_sheet_diff():
+            calls.append(1)
+            sleep(0.3)  # hanging Sheets API request
+            return SheetDiff(inserted=build_sheet_users(1))
+
+        async def run():
+            task = asyncio.create_task(self.sender.sync_sheet_loop())
+            await asyncio.sleep(1)
+            task.cancel()
+
+        self.sender.fetch_sheet_diff = fetch_sheet_diff
+        self.sender.sync_interval = 10
+        self.sender.sync_timeout = 0.1
+        asyncio.run(run())
+        assert len(calls) == 1  # timed out request is awaited, not duplicated
+        assert len(self.sender.sheet_diffs) == 1  # and its diff is still handed to main_loop
+
+    def test_sync_sheet_loop_backoff(self):
+        calls = []
+
+        def fetch_sheet_diff():
+            calls.append(1)
+            raise ConnectionError('quota exceeded')
+
+        async def run():
+            task = asyncio.create_task(self.sender.sync_sheet_loop())
+            await asyncio.sleep(0.65)
+            task.cancel()
+
+        self.sender.fetch_sheet_diff = fetch_sheet_diff
+        self.sender.sync_interval = 0.05
+        with patch.object(bot_module, 'handle_error'):
+            asyncio.run(run())
+        assert len(calls) == 3  # after 0.1s and 0.3s, the next one at 0.7s
+
+    def test_sheet_diff_during_send_not_duplicated(self):
+        users = build_db_users(3)
+        self.db.insert_users(self.db_conn, users)
+        customers = build_sheet_users(3)
+        self.sender.sheet_sync.customers = {customer_key(c): c for c in customers}
+        now = datetime.now().strftime(self.sender.scheduler.date_fmt)
+        day_start, day_end = self.sender.today_range()
+        self.db.replace_pending_jobs(
+            self.db_conn, [self.sender.build_task_job(user, now) for user in users],
+            day_start, day_end)
+        # the sheet keeps the same (already due) time for customer 1
+        phone_num = customers[1]['phone_num']
+        self.sender.build_task_jobs = lambda users, index, today=None: [
+            self.sender.build_task_job(user, now) for user in index.get(phone_num, [])]
+        self.sender.schedule_dirty = False
+        self.sender.dispatcher.bot.delay = 0.1
+
+        async def run():
+            self.sender.scheduler.replace(await self.async_db.get_due_jobs(day_start, day_end))
+            task = asyncio.create_task(self.sender.run())
+            await asyncio.sleep(0.05)  # reminders are in flight
+            self.sender.sheet_diffs.append(SheetDiff(updated=[customers[1]]))
+            self.sender.scheduler.notify()
+            await asyncio.sleep(0.2)
+            self.sender.stop()
+            await task
+
+        self.sender.fetch_sheet_diff = SheetDiff
+        asyncio.run(run())
+        assert sorted(uid for uid, _ in self.sender.dispatcher.bot.sent) == [0, 1, 2]
+        assert not self.sender.sheet_diffs
+
+    def test_send_task_retry(self):
+        day_start, day_end = self.sender.today_range()
+        jobs = [self.sender.build_task_job(user, day_start) for user in build_db_users(5)]
+        self.db.replace_pending_jobs(self.db_conn, jobs, day_start, day_end)
+        errors = {
+            0: Forbidden('bot was blocked by the user'),
+            1: RetryAfter(30),
+            2: NetworkError('connection reset'),
+            4: BadRequest("Can't parse entities"),
+        }
+
+        async def raw_send_message(chat_id, msg):
+            if chat_id in errors:
+                raise errors[chat_id]
+
+        async def run():
+            tasks = self.db.get_due_jobs(self.db_conn, day_start, day_end)
+            await asyncio.gather(*(self.sender.send_task(task) for task in tasks))
+
+        self.sender.raw_send_message = raw_send_message
+        with patch.object(bot_module, 'handle_error'):
+            asyncio.run(run())
+        rows = {
+            row[0]: row for row in self.db_conn.execute(
+                'SELECT uid, sent, attempts, retry_at, error FROM jobs')}
+        assert rows[0][1:3] == (1, 0) and 'Forbidden' in rows[0][4]  # closed, not retried
+        assert 0 in self.sender.unreachable and 1 not in self.sender.unreachable
+        assert rows[4][1:3] == (1, 0) and 'BadRequest' in rows[4][4]  # closed, not retried
+        assert 4 not in self.sender.unreachable  # but the chat is fine
+        assert rows[3][1:3] == (1, 0) and rows[3][4] is None
+        assert rows[1][1:3] == (0, 1) and rows[2][1:3] == (0, 1)
+        retry_in = datetime.strptime(rows[1][3], self.sender.scheduler.date_fmt) - datetime.now()
+        assert 28 <= retry_in.total_seconds() <= 31  # RetryAfter honored
+        assert len(self.sender.scheduler) == 2
+        # retry survives a schedule rebuild
+        self.db.replace_pending_jobs(self.db_conn, [], day_start, day_end)
+        pending = self.db.get_due_jobs(self.db_conn, day_start, day_end)
+        assert sorted(job['uid'] for job in pending) == [1, 2]
+        assert all(job['attempts'] == 1 for job in pending)
+
+    def test_stop_drains_in_flight_sends(self):
+        users = build_db_users(20)
+        self.db.insert_users(self.db_conn, users)
+        day_start, day_end = self.sender.today_range()
+        now = datetime.now().strftime(self.sender.scheduler.date_fmt)
+        self.db.replace_pending_jobs(
+            self.db_conn, [self.sender.build_task_job(user, now) for user in users],
+            day_start, day_end)
+        self.sender.sheet_sync.customers = {}
+        self.sender.fetch_sheet_diff = SheetDiff
+        self.sender.build_schedule = lambda: asyncio.sleep(0)  # keep the jobs above
+        self.sender.schedule_dirty = False
+        self.sender.dispatcher.bot.delay = 0.05
+
+        async def run():
+            self.sender.scheduler.replace(await self.async_db.get_due_jobs(day_start, day_end))
+            task = asyncio.create_task(self.sender.run())
+            await asyncio.sleep(0.02)  # sends are in flight
+            self.sender.stop()
+            await task
+
+        asyncio.run(run())
+        assert len(self.sender.dispatcher.bot.sent) == 20
+        assert not self.db.get_due_jobs(self.db_conn, day_start, day_end)
+        assert self.sender.dispatcher.bot.closed == 0  # session belongs to the Application
+
+    def test_failed_rebuild_retried(self):
+        calls = []
+
+        async def build_schedule():
+            calls.append(self.sender.schedule_dirty)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+
+        self.sender.build_schedule = build_schedule
+        self.sender.fetch_sheet_diff = SheetDiff
+        self.sender.rebuild_retry_delay = 0.05
+
+        async def run():
+            task = asyncio.create_task(self.sender.run())
+            await asyncio.sleep(0.3)
+            self.sender.stop()
+            await task
+
+        with patch.object(bot_module, 'handle_error') as handle_error:
+            asyncio.run(run())
+        handle_error.assert_called_once()
+        assert len(calls) == 2  # retried soon, not at midnight
+        assert not self.sender.schedule_dirty
+
+    @pytest.mark.slow
+    def test_build_task_jobs_benchmark(self):
+        users_db = build_db_users(1000, step=7)
+        for rows in (10_000, 100_000):
+            users = build_sheet_users(rows)
+            start = perf_counter()
+            nested = build_task_jobs_nested(self.sender, users, users_db)
+            nested_time = perf_counter() - start
+            start = perf_counter()
+            users_index = self.sender.build_users_index(users_db)
+            indexed = self.sender.build_task_jobs(users, users_index)
+            indexed_time = perf_counter() - start
+            assert nested == indexed
+            print(f'\n- build_task_jobs {rows} rows x {len(users_db)} users: '
+                  f'nested {nested_time:.3f}s, indexed {indexed_time:.3f}s, '
+                  f'speedup x{nested_time / indexed_time:.1f}')
+            assert indexed_time < nested_time
+
+
+class FakeAsyncDatabase:
+    def __init__(self, managers: list[User]):
+        self.managers = managers
+
+    async def get_managers(self) -> list[User]:
+        return self.managers
+
+
+class TestTelegramBot(TestCase):
+    def setUp(self):
+        self.telegram_bot = TelegramBot('123:test', config=load_config())
+        self.managers = build_db_users(15)
+        self.managers[3].uid = -1  # manager chat not found
+        self.telegram_bot.db = FakeAsyncDatabase(self.managers)
+
+    def test_notify_managers_concurrent_isolated(self):
+        bot = FakeBot()
+        start = perf_counter()
+        asyncio.run(self.telegram_bot.notify_managers(bot, 'review'))
+        elapsed = perf_counter() - start
+        assert len(bot.sent) == 14
+        assert elapsed < len(self.managers) * bot.delay / 2
+
+    def test_export_uploaded_in_parts(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        db = AsyncDatabase(Database(), os.path.join(tmp_dir.name, 'export.sqlite3'))
+        self.addCleanup(db.close)
+        conn = db.connections.get()
+        db.db.migrate(conn)
+        db.db.insert_reviews(conn, [
+            {'uid': i, 'phone_num': i, 'score': 1, 'comment': '', 'created': '2022-09-01'}
+            for i in range(5)])
+        self.telegram_bot.db = db
+        self.telegram_bot.check_manager = AsyncMock(return_value=True)
+        update = MagicMock()
+        documents = []
+
+        async def reply_document(fp, filename, caption):
+            documents.append((filename, len(fp.read().splitlines())))
+
+        update.message.reply_document = reply_document
+        update.message.reply_text = AsyncMock()
+        context = MagicMock(args=['jsonl'])
+        export_parts = partial(bot_module.export_parts, max_rows=2)
+        with patch.object(bot_module, 'export_parts', export_parts):
+            asyncio.run(self.telegram_bot.command_export(update, context))
+        assert documents == [
+            ('reviews-1.jsonl', 2), ('reviews-2.jsonl', 2), ('reviews-3.jsonl', 1)]
+        update.message.reply_text.assert_awaited_once_with('Выгружено отзывов: 5, файлов: 3')
@@ -0,0 +1,31 @@
+from unittest import TestCase
+from time import sleep
+
+from ..cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        assert cache.get(1) == 'a'  # 1 becomes most recent
+        cache.set(3, 'c')
+        assert 2 not in cache
+        assert cache.get(1) == 'a' and cache.get(3) == 'c'
+
+    def test_ttl_expire(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set(1, 'a')
+        assert cache.get(1) == 'a'
+        sleep(0.06)
+        assert cache.get(1) is None
+        assert not len(cache)
+
+    def test_stats(self):
+        cache = LRUCache()
+        cache.set(1, 'a')
+        cache.get(1)
+        cache.get(2)
+        assert cache.pop(1) == 'a'
+        assert cache.stats == {'size': 0, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
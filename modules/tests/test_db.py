@@ -1,10 +1,13 @@
+import asyncio
 import os
+import sqlite3
+import threading
 
 from unittest import TestCase
 from pathlib import Path
 
-from ..db import Database
-from ..users import User, build_user
+from ..db import AsyncDatabase, ConnectionManager, Database
+from ..users import User, UserRole, build_user
 from ..utils import load_json
 
 
@@ -28,8 +31,8 @@ class TestDatabase(TestCase):
                 test_bool boolean NOT NULL,
                 test_text text NOT NULL
             );""".format(self.db_table)
-        # create users table
-        self.db.create_table(self.db_conn, self.db.sql_create_users_table)
+        # bot schema: users, jobs, customers, reviews
+        self.db.migrate(self.db_conn)
         self.users = load_json('assets/users.json')
         self.user_tg = {
             'is_bot': False,
@@ -54,8 +57,10 @@ class TestDatabase(TestCase):
         self.db.insert_user(self.db_conn, user)
         user = self.db.get_user(self.db_conn, self.user_tg['id'])
         assert isinstance(user, User)
-        assert len(list(user.__dict__.keys())) == 8
-        assert len(list(user.__dict__.values())) == 8
+        assert isinstance(user.role, UserRole)
+        assert not hasattr(user, '__dict__')
+        assert len(User.field_names()) == 8
+        assert len(user.to_row()) == 8
 
     def test_insert_get_managers(self):
         user = build_user(self.users[0], self.user_tg, manager=True)
@@ -67,6 +72,21 @@ class TestDatabase(TestCase):
         assert users[0].username == 'DmitrydevPy'
         assert users[0].role == 'Менеджер'
 
+    def test_get_user_cache(self):
+        user = build_user(self.users[0], self.user_tgg)
+        self.db.delete_object(self.db_conn, 'users', 'uid', user.uid)
+        self.db.insert_user(self.db_conn, user)
+        hits = self.db.users_cache.hits
+        self.db.get_user(self.db_conn, user.uid)
+        cached = self.db.get_user(self.db_conn, user.uid)
+        assert self.db.users_cache.hits == hits + 1
+        self.db.update_object(self.db_conn, 'users', 'role', 'uid', ('Менеджер', user.uid))
+        assert self.db.get_user(self.db_conn, user.uid) is not cached
+        assert self.db.get_user(self.db_conn, user.uid).role == 'Менеджер'
+        self.db.delete_object(self.db_conn, 'users', 'uid', user.uid)
+        with self.assertRaises(IndexError):
+            self.db.get_user(self.db_conn, user.uid)
+
     def insert_test_objects(self):
         test_fields = ('test_bool', 'test_text')
         test_data = [(True, 'test1'), (False, 'test2'), (True, 'test3')]
@@ -77,6 +97,23 @@ class TestDatabase(TestCase):
         self.assertTrue(self.db_conn)
         self.assertTrue(Path(self.db_file).is_file())
 
+    def test_db_connection_pragmas(self):
+        cur = self.db_conn.cursor()
+        assert cur.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert cur.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+        assert cur.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+    def test_connection_manager_per_thread(self):
+        connections = ConnectionManager(self.db, db_file=self.db_file)
+        conns = []
+        thread = threading.Thread(target=lambda: conns.append(connections.get()))
+        thread.start()
+        thread.join()
+        assert connections.get() is connections.get()
+        assert connections.get() is not conns[0]
+        connections.close_all()
+        assert not connections.connections
+
     def test_db_create_table(self):
         created = self.db.create_table(self.db_conn, sql=self.sql_test_table)
         self.assertTrue(created)
@@ -105,6 +142,33 @@ class TestDatabase(TestCase):
         for obj in qs:
             self.assertTrue(obj[0] != 2)
 
+    def test_insert_object_quotes(self):
+        self.db.insert_object(self.db_conn, self.db_table, ('test_bool', 'test_text'), (
+            True, "O'Neil"))
+        qs = self.db.get_objects_filter_by_value(
+            self.db_conn, self.db_table, 'test_text', "O'Neil")
+        assert len(qs) == 1
+        self.db.delete_object(self.db_conn, self.db_table, 'test_text', "O'Neil")
+        assert not self.db.get_objects_filter_by_value(
+            self.db_conn, self.db_table, 'test_text', "O'Neil")
+
+    def test_bulk_insert_users_one_transaction(self):
+        tg_users = [
+            {'username': f'bulk{i}', 'first_name': 'bulk', 'id': 10_000_000 + i}
+            for i in range(10_000)
+        ]
+        users = [build_user(self.users[0], tg_user) for tg_user in tg_users]
+        statements = []
+        self.db_conn.set_trace_callback(statements.append)
+        self.db.insert_users(self.db_conn, users)
+        self.db_conn.set_trace_callback(None)
+        assert statements.count('COMMIT') == 1
+        uids = [user.uid for user in users]
+        self.db.update_objects(self.db_conn, 'users', 'role', 'uid', [('Менеджер', uids[0])])
+        assert self.db.get_user(self.db_conn, uids[0]).role == 'Менеджер'
+        self.db.delete_objects(self.db_conn, 'users', 'uid', uids)
+        assert not self.db.get_objects_filter_by_value(self.db_conn, 'users', 'first_name', 'bulk')
+
     def test_get_objects_filter_by_value(self):
         qs = self.db.get_objects_filter_by_value(self.db_conn, self.db_table, 'test_bool', False)
         self.assertTrue(not len(qs))
@@ -118,3 +182,169 @@ class TestDatabase(TestCase):
         for obj in qs:
             self.assertTrue(isinstance(obj, str))
             self.assertTrue('test' in obj)
+        # row factory of the connection is left untouched
+        qs = self.db.get_objects_all(self.db_conn, self.db_table)
+        assert isinstance(qs[0], tuple)
+
+    def test_replace_get_due_jobs(self):
+        day_start, day_end = '2022-09-05 00:00:00', '2022-09-05 23:59:59'
+        jobs = [
+            {'uid': 1, 'phone_num': 1, 'job_at': '2022-09-05 11:00:00', 'sent': False},
+            {'uid': 2, 'phone_num': 2, 'job_at': '2022-09-05 20:00:00', 'sent': False},
+        ]
+        self.db.replace_pending_jobs(self.db_conn, jobs, day_start, day_end)
+        due = self.db.get_due_jobs(self.db_conn, day_start, day_end)
+        assert [job['uid'] for job in due] == [1, 2]
+        self.db.mark_job_sent(self.db_conn, due[0]['id'])
+        # sent job survives rebuild, pending job of removed user is dropped
+        self.db.replace_pending_jobs(self.db_conn, jobs[:1], day_start, day_end)
+        assert not self.db.get_due_jobs(self.db_conn, day_start, day_end)
+        self.db.delete_jobs_before(self.db_conn, '2022-09-06 00:00:00')
+        assert not self.db.get_objects_all(self.db_conn, 'jobs')
+
+    def test_replace_get_customer(self):
+        customers = [
+            {'phone_num': 1, 'adress': 'a', 'full_name': 'n1', 'clean_time': 'Ежедневно в 20:00'},
+            {'phone_num': 2, 'adress': "O'Neil st", 'full_name': 'n2', 'clean_time': '-'},
+        ]
+        self.db.replace_customers(self.db_conn, customers)
+        assert self.db.get_customer(self.db_conn, 2) == customers[1]
+        updated = dict(customers[0], full_name='changed')
+        second = dict(customers[0], adress='b', clean_time='-')
+        self.db.replace_customers(self.db_conn, [updated, second], deleted=[customers[1]])
+        rows = self.db.get_objects_filter_by_value(self.db_conn, 'customers', 'phone_num', 1)
+        assert len(rows) == 2  # one phone, two adresses
+        assert self.db.get_customer(self.db_conn, 1)['full_name'] == 'changed'
+        with self.assertRaises(IndexError):
+            self.db.get_customer(self.db_conn, 2)
+
+
+class TestAsyncDatabase(TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.adb = AsyncDatabase(self.db, db_file=test_db, workers=4)
+        self.db_conn = self.db.create_connection(db_file=test_db)
+        self.db.create_table(self.db_conn, self.db.sql_create_users_table)
+
+    def tearDown(self):
+        self.adb.close()
+        self.db_conn.close()
+
+    def test_concurrent_queries(self):
+        users = load_json('assets/users.json')
+        tg_users = [
+            {'is_bot': False, 'username': f'user{i}', 'first_name': 'test', 'id': 100 + i}
+            for i in range(8)
+        ]
+        threads = set()
+
+        async def run():
+            await asyncio.gather(*(
+                self.adb.insert_user(build_user(users[0], tg_user)) for tg_user in tg_users))
+            return await asyncio.gather(*(
+                self.adb.call_in_thread(tg_user['id']) for tg_user in tg_users))
+
+        def call_in_thread(conn, user_id):
+            threads.add(threading.get_ident())
+            return self.db.get_user(conn, user_id)
+
+        self.db.call_in_thread = call_in_thread
+        result = asyncio.run(run())
+        assert [user.uid for user in result] == [tg_user['id'] for tg_user in tg_users]
+        assert threading.get_ident() not in threads
+
+
+class TestMigrations(TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db_conn = self.db.create_connection(db_file=':memory:')
+
+    def tearDown(self):
+        self.db_conn.close()
+
+    def query_plan(self, sql: str, params=()) -> str:
+        cur = self.db_conn.cursor()
+        rows = cur.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        return ' '.join(row[-1] for row in rows)
+
+    def test_migrate_idempotent(self):
+        version = self.db.migrate(self.db_conn)
+        assert version == len(self.db.migrations)
+        assert self.db.migrate(self.db_conn) == version
+        cur = self.db_conn.cursor()
+        assert cur.execute('PRAGMA user_version').fetchone()[0] == version
+
+    def test_customers_rekeyed_from_v5(self):
+        migrations = self.db.migrations
+        self.db.migrations = migrations[:5]  # a database deployed before migration 6
+        self.db.migrate(self.db_conn)
+        self.db_conn.execute(
+            "INSERT INTO customers VALUES (1, 'ул. Мира 2', 'a', 'Ежедневно в 20:00')")
+        with self.assertRaises(sqlite3.IntegrityError):  # v1 schema: one row per phone
+            self.db_conn.execute("INSERT INTO customers VALUES (1, 'ул. Мира 3', 'a', '')")
+        self.db_conn.commit()
+        self.db.migrations = migrations
+        assert self.db.migrate(self.db_conn) == len(migrations)
+        self.db_conn.execute("INSERT INTO customers VALUES (1, 'ул. Мира 3', 'a', '')")
+        rows = self.db_conn.execute('SELECT phone_num, adress FROM customers ORDER BY adress')
+        assert rows.fetchall() == [(1, 'ул. Мира 2'), (1, 'ул. Мира 3')]
+
+    def test_hot_queries_use_index(self):
+        self.db.migrate(self.db_conn)
+        plans = {
+            'users_role': ('SELECT * FROM users WHERE role=?', ('Менеджер',)),
+            'users_phone_num': ('SELECT * FROM users WHERE phone_num=?', (1,)),
+            'jobs_sent_job_at': (
+                'SELECT * FROM jobs WHERE sent=0 AND job_at BETWEEN ? AND ?', ('a', 'b')),
+            'jobs_uid_sent_job_at': (
+                'SELECT * FROM jobs WHERE uid=? AND sent=0 AND job_at BETWEEN ? AND ?',
+                (1, 'a', 'b')),
+            'reviews_created': (
+                'SELECT * FROM reviews WHERE created >= ? AND created < ? ORDER BY created',
+                ('a', 'b')),
+        }
+        for index, (sql, params) in plans.items():
+            plan = self.query_plan(sql, params)
+            assert f'USING INDEX {index}' in plan, plan
+        plan = self.query_plan(
+            'DELETE FROM jobs WHERE uid=? AND sent=0 AND job_at BETWEEN ? AND ?'
+            ' AND retry_at IS NULL', (1, 'a', 'b'))
+        assert 'USING INDEX jobs_uid_sent_job_at' in plan, plan
+        assert 'USING INTEGER PRIMARY KEY' in self.query_plan(
+            'SELECT * FROM users WHERE uid=?', (1,))
+        assert 'USING PRIMARY KEY' in self.query_plan(
+            'SELECT * FROM customers WHERE phone_num=?', (1,))
+
+    def test_review_adress_of_shared_phone(self):
+        self.db.migrate(self.db_conn)
+        self.db.replace_customers(self.db_conn, [
+            {'phone_num': 3, 'adress': adress, 'full_name': 'a', 'clean_time': ''}
+            for adress in ('ул. Мира 7', 'ул. Мира 8')])
+        review = {'uid': 3, 'phone_num': 3, 'score': -1, 'comment': '', 'created': '2022-09-03'}
+        self.db.insert_reviews(self.db_conn, [review, dict(review, adress='ул. Мира 8')])
+        rows = self.db_conn.execute('SELECT adress FROM reviews WHERE phone_num=3 ORDER BY id')
+        assert [row[0] for row in rows] == [None, 'ул. Мира 8']  # ambiguous phone -> NULL
+        assert self.db.get_review_stats(self.db_conn, 'adress', 'ул. Мира 7')['reviews'] == 0
+        assert self.db.get_review_stats(self.db_conn, 'adress', 'ул. Мира 8')['reviews'] == 1
+
+    def test_reviews_rolling_stats(self):
+        self.db.migrate(self.db_conn)
+        self.db.replace_customers(self.db_conn, [{
+            'phone_num': 1, 'adress': 'ул. Мира 2', 'full_name': 'a', 'clean_time': ''}])
+        reviews = [
+            {'uid': 1, 'phone_num': 1, 'score': 2, 'comment': '', 'created': '2022-09-01 10:00'},
+            {'uid': 1, 'phone_num': 1, 'score': -2, 'comment': '', 'created': '2022-09-02 10:00'},
+            {'uid': 2, 'phone_num': 2, 'score': 1, 'comment': '', 'created': '2022-09-02 11:00'},
+        ]
+        self.db.insert_reviews(self.db_conn, reviews)
+        assert self.db.get_review_stats(self.db_conn, 'total') == {
+            'reviews': 3, 'negative': 1, 'avg_score': 0.33}
+        assert self.db.get_review_stats(self.db_conn, 'customer', 1)['reviews'] == 2
+        assert self.db.get_review_stats(self.db_conn, 'adress', 'ул. Мира 2')['negative'] == 1
+        assert self.db.get_review_stats(self.db_conn, 'day', '2022-09-02')['reviews'] == 2
+        week = self.db.get_review_stats(self.db_conn, 'day', '2022-08-27', '2022-09-02')
+        assert week['reviews'] == 3
+        assert self.db.get_review_stats(self.db_conn, 'day', '2022-09-03')['reviews'] == 0
+        plan = self.query_plan(
+            'SELECT * FROM review_stats WHERE scope=? AND key BETWEEN ? AND ?', ('day', 'a', 'b'))
+        assert 'USING PRIMARY KEY' in plan, plan
@@ -0,0 +1,73 @@
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from ..digest import BatchBuffer, ReviewDigest
+
+
+class TestReviewDigest(TestCase):
+    def setUp(self):
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+    def test_flush_by_size(self):
+        digest = ReviewDigest(self.send, max_size=10, interval=60)
+
+        async def run():
+            for i in range(100):
+                await digest.add(f'review {i}')
+
+        asyncio.run(run())
+        assert len(self.sent) == 10  # 100 reviews -> 10 messages
+        assert self.sent[0].startswith('<b>Сводка отзывов (10):</b>')
+        assert 'review 99' in self.sent[-1]
+        assert not digest.items
+
+    def test_flush_by_time_and_urgent(self):
+        digest = ReviewDigest(self.send, max_size=10, interval=0.1)
+
+        async def run():
+            await digest.add('review 1')
+            await digest.add('bad review', urgent=True)
+            assert self.sent == ['bad review']  # negative score is not buffered
+            await asyncio.sleep(0.2)
+
+        asyncio.run(run())
+        assert len(self.sent) == 2
+        assert 'review 1' in self.sent[1]
+        assert digest.timer is None
+
+    def test_split_long_digest(self):
+        digest = ReviewDigest(self.send)
+        messages = digest.build_messages(['x' * 3000] * 3)
+        assert len(messages) == 3
+        assert all(len(text) <= digest.msg_limit for text in messages)
+
+
+class TestBatchBuffer(TestCase):
+    def test_failed_flush_keeps_items(self):
+        batches = []
+
+        async def handler(items):
+            if not batches:
+                batches.append(None)
+                raise ConnectionError('db is locked')
+            batches.append(items)
+
+        buffer = BatchBuffer(handler, max_size=2, interval=0.1)
+
+        async def run():
+            await buffer.add(1)
+            await buffer.add(2)  # flush by size fails
+            assert buffer.items == [1, 2] and buffer.timer
+            await buffer.add(3)  # no size flush until the retry succeeds
+            await asyncio.sleep(0.2)
+
+        with patch('modules.digest.handle_error') as handle_error:
+            asyncio.run(run())
+        handle_error.assert_called_once()
+        assert batches == [None, [1, 2, 3]]
+        assert not buffer.items and not buffer.failed
@@ -0,0 +1,77 @@
+import csv
+import io
+import json
+import os
+import tempfile
+
+from unittest import TestCase
+
+from ..db import Database
+from ..export import export_parts, export_reviews, iter_csv, main
+
+
+class TestExport(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmp_dir.name, 'export.sqlite3')
+        self.db = Database()
+        self.db_conn = self.db.create_connection(self.db_file)
+        self.db.migrate(self.db_conn)
+        self.db.insert_reviews(self.db_conn, [
+            {'uid': i, 'phone_num': i, 'score': i % 5 - 2, 'comment': f'"ok", {i}',
+             'created': f'2022-09-{i % 30 + 1:02d} 10:00:00'}
+            for i in range(3000)
+        ])
+
+    def tearDown(self):
+        self.db_conn.close()
+        self.tmp_dir.cleanup()
+
+    def test_export_csv_date_range(self):
+        fp = io.BytesIO()
+        count = export_reviews(
+            self.db, self.db_file, fp, 'csv', date_from='2022-09-01', date_to='2022-09-10')
+        rows = list(csv.reader(io.StringIO(fp.getvalue().decode('utf-8'))))
+        assert count == 1000
+        assert len(rows) == count + 1
+        assert rows[0][0] == 'id'
+        assert rows[1][5] == '"ok", 0'
+        assert rows[-1][6].startswith('2022-09-10')
+
+    def test_export_jsonl(self):
+        fp = io.BytesIO()
+        assert export_reviews(self.db, self.db_file, fp, 'jsonl') == 3000
+        lines = fp.getvalue().decode('utf-8').splitlines()
+        assert json.loads(lines[0])['comment'] == '"ok", 0'
+
+    def test_export_parts_bounded(self):
+        sizes = []
+        rows = []
+        for fp, count in export_parts(self.db, self.db_file, 'csv', max_bytes=20_000):
+            data = fp.read()
+            sizes.append(len(data))
+            part = list(csv.reader(io.StringIO(data.decode('utf-8'))))
+            assert part[0][0] == 'id' and len(part) == count + 1  # own header
+            rows += part[1:]
+        assert len(sizes) > 1 and max(sizes) < 20_000 * 2
+        assert len({row[0] for row in rows}) == len(rows) == 3000  # no row lost or repeated
+        parts = export_parts(self.db, self.db_file, 'jsonl', max_rows=1000)
+        assert [count for _, count in parts] == [1000, 1000, 1000]
+        empty = export_parts(self.db, self.db_file, 'jsonl', date_from='2023-01-01')
+        assert [count for _, count in empty] == [0]
+
+    def test_export_streams_without_locking_writer(self):
+        conn = self.db.create_connection(self.db_file)
+        chunks = iter_csv(self.db.iter_reviews(conn, batch_size=100), chunk_size=1024)
+        next(chunks)  # read in progress
+        self.db.insert_reviews(self.db_conn, [
+            {'uid': 1, 'phone_num': 1, 'score': 0, 'comment': '', 'created': '2022-10-01'}])
+        assert sum(len(chunk) for chunk in chunks) > 0
+        conn.close()
+        assert self.db.get_review_stats(self.db_conn, 'total')['reviews'] == 3001
+
+    def test_cli(self):
+        output = os.path.join(self.tmp_dir.name, 'reviews.jsonl')
+        main(['--format', 'jsonl', '--from', '2022-09-30', '--db', self.db_file, '-o', output])
+        with open(output, encoding='utf-8') as f:
+            assert len(f.readlines()) == 100
@@ -0,0 +1,61 @@
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+from time import monotonic
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from ..locks import UserSerialApplication
+from .test_webhook import build_updates
+
+
+class TestUserSerialApplication(TestCase):
+    def build_application(self, concurrent_updates: int, handler) -> UserSerialApplication:
+        application = Application.builder().token('123:test').application_class(
+            UserSerialApplication).concurrent_updates(concurrent_updates).build()
+        application.add_handler(TypeHandler(Update, handler))
+        return application
+
+    def run_queue(self, application: UserSerialApplication, updates: list[dict]) -> None:
+        async def run():
+            async with application:  # no network: Bot.initialize calls get_me
+                await application.start()
+                for data in updates:
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                await application.update_queue.join()
+                await application.stop()
+
+        with patch.object(type(application.bot), 'initialize', AsyncMock()):
+            asyncio.run(run())
+
+    def test_concurrent_users_serial_per_user(self):
+        spans = {}
+
+        async def handler(update, context):
+            start = monotonic()
+            await asyncio.sleep(0.05)
+            spans.setdefault(update.effective_user.id, []).append((start, monotonic()))
+
+        application = self.build_application(16, handler)
+        started = monotonic()
+        self.run_queue(application, build_updates(4) * 2)
+        assert monotonic() - started < 8 * 0.05 / 2  # 4 users in parallel
+        for (first_start, first_end), (second_start, _) in spans.values():
+            assert second_start >= first_end  # one user's updates never overlap
+        assert not application.user_queues
+
+    def test_flooding_user_does_not_delay_others(self):
+        handled = {}
+        started = monotonic()
+
+        async def handler(update, context):
+            await asyncio.sleep(0.05)
+            handled.setdefault(update.effective_user.id, []).append(monotonic() - started)
+
+        application = self.build_application(2, handler)
+        flood = build_updates(1) * 20  # user 0 sends 20 updates in a row
+        self.run_queue(application, flood + build_updates(2)[1:])
+        assert len(handled[0]) == 20
+        assert handled[1][0] < handled[0][2]  # not queued behind user 0's permits
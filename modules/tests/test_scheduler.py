@@ -0,0 +1,52 @@
+import asyncio
+
+from unittest import TestCase
+from datetime import datetime, timedelta
+from time import monotonic
+
+from ..scheduler import JobScheduler
+
+
+class TestJobScheduler(TestCase):
+    def setUp(self):
+        self.scheduler = JobScheduler()
+        self.now = datetime(2022, 9, 5, 12, 0, 0)
+
+    def build_job(self, uid: int, delta: int) -> dict:
+        job_at = self.now + timedelta(seconds=delta)
+        return {'uid': uid, 'phone_num': uid, 'job_at': str(job_at), 'sent': False}
+
+    def test_pop_due_in_order(self):
+        jobs = [self.build_job(3, 30), self.build_job(1, -10), self.build_job(2, 0)]
+        self.scheduler.replace(jobs)
+        due = self.scheduler.pop_due(self.now)
+        assert [job['uid'] for job in due] == [1, 2]
+        assert len(self.scheduler) == 1
+        assert self.scheduler.next_due() == self.now + timedelta(seconds=30)
+
+    def test_push_retry_due(self):
+        job = self.build_job(1, 0)
+        self.scheduler.push(job, due=self.now + timedelta(seconds=10))
+        assert not self.scheduler.pop_due(self.now)
+        assert self.scheduler.pop_due(self.now + timedelta(seconds=10)) == [job]
+
+    def test_wait_until_due(self):
+        async def wait():
+            self.scheduler.replace([self.build_job(1, 0)])
+            self.scheduler._changed.clear()
+            start = monotonic()
+            changed = await self.scheduler.wait(timeout=5)
+            return changed, monotonic() - start
+        changed, elapsed = asyncio.run(wait())
+        assert not changed
+        assert elapsed < 1
+
+    def test_wait_wakes_on_change(self):
+        async def wait():
+            asyncio.get_running_loop().call_later(0.05, self.scheduler.notify)
+            start = monotonic()
+            changed = await self.scheduler.wait(timeout=5)
+            return changed, monotonic() - start
+        changed, elapsed = asyncio.run(wait())
+        assert changed
+        assert elapsed < 1
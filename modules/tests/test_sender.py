@@ -0,0 +1,111 @@
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import patch
+from time import monotonic
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from ..sender import (
+    MessageDispatcher, TokenBucket, is_chat_unreachable, is_permanent_error, retry_delay,
+)
+
+
+class FakeBot:
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.sent = []
+        self.initialized = 0
+        self.closed = 0
+
+    async def initialize(self):
+        self.initialized += 1
+
+    async def shutdown(self):
+        self.closed += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        if chat_id < 0:
+            raise BadRequest('Chat not found')
+        self.sent.append((chat_id, text))
+        return chat_id
+
+
+class TestTokenBucket(TestCase):
+    def test_try_acquire(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        assert bucket.try_acquire() == 0
+        assert bucket.try_acquire() == 0
+        delay = bucket.try_acquire()
+        assert 0 < delay <= 0.1
+
+
+class TestRetry(TestCase):
+    def test_permanent_errors(self):
+        assert is_permanent_error(BadRequest('Chat not found'))
+        assert is_permanent_error(Forbidden('bot was blocked by the user'))
+        assert not is_permanent_error(NetworkError('connection reset'))
+        assert not is_permanent_error(RetryAfter(5))
+        assert is_chat_unreachable(BadRequest('Bad Request: chat not found'))
+        assert is_chat_unreachable(Forbidden('bot was blocked by the user'))
+        assert is_chat_unreachable(BadRequest('User is deactivated'))
+        assert not is_chat_unreachable(BadRequest('Message text is empty'))
+        assert not is_chat_unreachable(NetworkError('chat not found'))
+
+    def test_retry_delay(self):
+        assert 30 <= retry_delay(RetryAfter(30), attempt=1) <= 31
+        error = NetworkError('connection reset')
+        delays = [retry_delay(error, attempt, base=10, cap=3600) for attempt in range(1, 13)]
+        assert 5 <= delays[0] <= 10
+        assert 40 <= delays[3] <= 80
+        assert all(1800 <= delay <= 3600 for delay in delays[-2:])  # capped
+
+
+class TestMessageDispatcher(TestCase):
+    def test_concurrent_send_one_session(self):
+        bot = FakeBot()
+
+        async def send():
+            async with MessageDispatcher(bot=bot, workers=10, global_rate=100) as dispatcher:
+                start = monotonic()
+                await asyncio.gather(*(dispatcher.send(uid, 'msg') for uid in range(20)))
+                return dispatcher, monotonic() - start
+        dispatcher, elapsed = asyncio.run(send())
+        assert len(bot.sent) == 20
+        assert bot.initialized == 1 and bot.closed == 1
+        assert elapsed < 20 * bot.delay / 2  # sent concurrently
+        assert dispatcher.stats['sent'] == 20
+        assert dispatcher.throughput > 0
+
+    def test_shared_bot_no_own_pool(self):
+        with patch('modules.sender.HTTPXRequest') as request:
+            MessageDispatcher(bot=FakeBot())
+            request.assert_not_called()  # the Application's bot brings its own pool
+            MessageDispatcher('123:test', workers=4)
+            request.assert_called_once_with(connection_pool_size=4)
+
+    def test_per_chat_limit(self):
+        bot = FakeBot(delay=0)
+
+        async def send():
+            async with MessageDispatcher(bot=bot, workers=4, chat_rate=10) as dispatcher:
+                start = monotonic()
+                await asyncio.gather(*(dispatcher.send(1, 'msg') for _ in range(3)))
+                return monotonic() - start
+        elapsed = asyncio.run(send())
+        assert elapsed >= 0.15  # 3 messages to one chat at 10 msg/s
+
+    def test_error_isolated(self):
+        bot = FakeBot(delay=0)
+
+        async def send():
+            async with MessageDispatcher(bot=bot) as dispatcher:
+                results = await asyncio.gather(
+                    dispatcher.send(-1, 'msg'), dispatcher.send(1, 'msg'),
+                    return_exceptions=True)
+                return dispatcher, results
+        dispatcher, results = asyncio.run(send())
+        assert isinstance(results[0], BadRequest)
+        assert results[1] == 1
+        assert dispatcher.stats['failed'] == 1
@@ -0,0 +1,104 @@
+import os
+import tempfile
+
+from unittest import TestCase
+
+from ..sheets import FakeWorksheet, SheetClient, SheetSync
+from ..utils import load_json
+
+
+class TestSheetSync(TestCase):
+    def setUp(self):
+        self.rows = [
+            ['Адрес', 'ФИО', 'Телефон', 'Время уборки'],
+            ['ул. Ленина 1', 'Иванов Иван', '89990001122', 'Ежедневно в 20:00'],
+            ['ул. Мира 2', 'Петров Петр', '89990003344', '5/2 Будние дни, в 11:00'],
+            ['ул. Мира 3', 'Без номера', 'нет', 'Ежедневно в 10:00'],
+        ]
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.users_path = os.path.join(self.tmp_dir.name, 'users.json')
+        self.worksheet = FakeWorksheet(self.rows)
+        self.client = SheetClient(page_size=2)
+        self.client.worksheet = self.worksheet
+        self.sync = SheetSync(users_path=self.users_path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_initial_sync_inserts(self):
+        with self.assertLogs(level='WARNING') as logs:
+            diff = self.sync.sync(self.client.iter_rows())
+        assert logs.output == [
+            "WARNING:root:Sheet row 4 skipped: invalid literal for int() with base 10: 'нет'"]
+        assert len(diff.inserted) == 2
+        assert not diff.updated and not diff.deleted
+        assert len(load_json(self.users_path)) == 2
+
+    def test_unchanged_sheet_skips_rewrite(self):
+        self.sync.sync(self.client.iter_rows())
+        mtime = os.stat(self.users_path).st_mtime_ns
+        diff = self.sync.sync(self.client.iter_rows())
+        assert not diff
+        assert os.stat(self.users_path).st_mtime_ns == mtime
+        # state restored from file produces no diff either
+        sync = SheetSync(users_path=self.users_path)
+        assert not sync.sync(self.client.iter_rows())
+
+    def test_corrupt_snapshot_skipped_and_replaced(self):
+        with open(self.users_path, 'w', encoding='utf-8') as f:
+            f.write('[{"adress": "ул. Ленина 1", "full_na')  # crash mid-write
+        sync = SheetSync(users_path=self.users_path)
+        assert not sync.customers
+        assert len(sync.sync(self.client.iter_rows()).inserted) == 2
+        assert len(load_json(self.users_path)) == 2
+        assert os.listdir(self.tmp_dir.name) == ['users.json']  # no temp files left
+
+    def test_row_level_diff(self):
+        self.sync.sync(self.client.iter_rows())
+        self.rows[1][3] = 'Ежедневно в 21:00'
+        del self.rows[2]
+        self.rows.append(['ул. Новая 4', 'Сидоров', '89990005566', 'суббота в 9:00'])
+        diff = self.sync.sync(self.client.iter_rows())
+        assert [c['phone_num'] for c in diff.updated] == [89990001122]
+        assert [c['phone_num'] for c in diff.deleted] == [89990003344]
+        assert [c['phone_num'] for c in diff.inserted] == [89990005566]
+        assert diff.phone_nums == {89990001122, 89990003344, 89990005566}
+        assert sorted(self.sync.customers) == [
+            (89990001122, 'ул. Ленина 1'), (89990005566, 'ул. Новая 4')]
+        customer = self.sync.customers[89990001122, 'ул. Ленина 1']
+        assert customer['clean_time'] == 'Ежедневно в 21:00'
+
+    def test_same_phone_several_adresses(self):
+        self.rows.append(['ул. Мира 5', 'Петров Петр', '89990003344', 'суббота в 9:00'])
+        self.rows.append(['ул. Мира 5', 'Петров Петр', '89990003344', 'суббота в 10:00'])
+        with self.assertLogs(level='WARNING'):  # exact duplicate row is reported
+            diff = self.sync.sync(self.client.iter_rows())
+        assert len(diff.inserted) == 3
+        assert self.sync.customers[89990003344, 'ул. Мира 5']['clean_time'] == 'суббота в 10:00'
+        del self.rows[2]
+        diff = self.sync.sync(self.client.iter_rows())
+        assert [c['adress'] for c in diff.deleted] == ['ул. Мира 2']
+        assert (89990003344, 'ул. Мира 5') in self.sync.customers
+
+    def test_client_paged_column_range(self):
+        for row in self.rows:
+            row.append('лишняя колонка')
+        rows = list(self.client.iter_rows())
+        assert self.worksheet.fetches == 3  # 2 full pages + empty page
+        assert len(rows) == 4
+        assert all(len(row) == 4 for row in rows)
+        assert self.client.get_worksheet() is self.worksheet
+        del self.rows[-1]
+        self.worksheet.fetches = 0
+        assert len(list(self.client.iter_rows())) == 3
+        assert self.worksheet.fetches == 2  # short last page ends the read
+
+    def test_blank_gap_across_page_boundary(self):
+        self.sync.sync(self.client.iter_rows())
+        self.rows[2:2] = [['', '', '', '']] * 3  # blank rows 3-5
+        self.worksheet.grid_rows = 1000  # grid of a real sheet is larger than its data
+        self.worksheet.fetches = 0
+        self.client.page_size = 4  # page 1 (rows 1-4) comes back with 2 rows only
+        diff = self.sync.sync(self.client.iter_rows())
+        assert not diff.deleted  # customers after the gap are still read
+        assert self.worksheet.fetches == 1000 // 4  # bounded by the sheet grid
@@ -0,0 +1,57 @@
+import asyncio
+
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from ..locks import UserSerialApplication
+from ..throttle import UpdateThrottle
+from .test_webhook import build_updates
+
+
+class TestUpdateThrottle(TestCase):
+    def test_allow_per_user_bounded(self):
+        throttle = UpdateThrottle(rate=0.01, capacity=3, maxsize=2)
+        assert [throttle.allow(1) for _ in range(5)] == [True] * 3 + [False] * 2
+        assert throttle.allow(2)  # other users are not affected
+        throttle.allow(3)
+        assert len(throttle.buckets) == 2  # least recently active user evicted
+        assert throttle.stats == {'users': 2, 'passed': 5, 'dropped': 2}
+
+    def test_flood_stopped_before_handlers(self):
+        throttle = UpdateThrottle(rate=0.01, capacity=2)
+        application = Application.builder().token('123:test').application_class(
+            UserSerialApplication).concurrent_updates(4).build()
+        application.throttle = throttle
+        handled = []
+
+        async def handler(update, context):
+            handled.append(update.effective_user.id)
+
+        application.add_handler(TypeHandler(Update, handler))
+        flood = build_updates(1) * 10 + build_updates(2)
+        flood.append({
+            'update_id': 100,
+            'callback_query': {
+                'id': '1', 'chat_instance': '1', 'data': '5',
+                'from': {'id': 0, 'is_bot': False, 'first_name': 'user0'},
+            },
+        })
+
+        async def run():
+            async with application:
+                await application.start()
+                for data in flood:
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                await application.update_queue.join()
+                await application.stop()
+
+        bot_class = type(application.bot)
+        with patch.object(bot_class, 'initialize', AsyncMock()), \
+                patch.object(bot_class, 'answer_callback_query', AsyncMock()) as answer:
+            asyncio.run(run())
+        assert handled == [0, 0, 1]
+        assert throttle.dropped == 9 + 1  # the button press of user 0 too
+        answer.assert_awaited_once()  # dropped button press is still answered
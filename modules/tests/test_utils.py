@@ -1,7 +1,14 @@
 from unittest import TestCase
 from datetime import datetime
 
-from ..utils import load_config, slice_sheet_dates, format_cleaning_date, gspread_connect_save_users
+from ..utils import (
+    load_config,
+    slice_sheet_dates,
+    format_cleaning_date,
+    compile_clean_time,
+    week_due_times,
+    gspread_connect_save_users,
+)
 
 
 class TestUtils(TestCase):
@@ -58,5 +65,34 @@ class TestUtils(TestCase):
         assert results[2] == f'{today} 11:00:00'
         assert results[-1] == f'{today} 13:30:00'
 
+    def test_compile_clean_time(self):
+        schedules = [compile_clean_time(i) for i in self.dates]
+        assert schedules[0].days == 0b1111111
+        assert schedules[0].minutes == 20 * 60
+        assert schedules[2].days == 0b0011111
+        assert schedules[3].days == 0b0001001
+        assert schedules[3].minutes == 13 * 60 + 30
+        assert schedules[-1].minutes == 13 * 60 + 30
+        assert compile_clean_time('по договоренности') is None
+        with self.assertLogs(level='WARNING'):
+            assert compile_clean_time('Ежедневно в 24:00') is None  # one bad row, not a crash
+        assert compile_clean_time('Ежедневно в 9:60') is None
+        assert compile_clean_time(self.dates[4]) is schedules[2]  # cached by source string
+        assert compile_clean_time.cache_info().maxsize
+
+    def test_schedule_job_at(self):
+        monday, sunday = datetime(2022, 9, 5).date(), datetime(2022, 9, 11).date()
+        schedule = compile_clean_time('понедельник, четверг в 9:05')
+        assert schedule.job_at(monday) == '2022-09-05 09:05:00'
+        assert schedule.job_at(sunday) is None
+
+    def test_week_due_times(self):
+        schedules = [compile_clean_time(i) for i in self.dates] + [None]
+        due_times = week_due_times(schedules, datetime(2022, 9, 5).date())
+        assert len(due_times[0]) == 7
+        assert len(due_times[2]) == 5
+        assert due_times[3] == [datetime(2022, 9, 5, 13, 30), datetime(2022, 9, 8, 13, 30)]
+        assert due_times[-1] == []
+
     def test_gspread_connect(self):
         gspread_connect_save_users()
@@ -0,0 +1,106 @@
+import asyncio
+import configparser
+
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock
+
+from telegram import Bot
+
+from ..bot import TelegramBot
+from ..webhook import WebhookClient, WebhookServer
+
+
+def build_updates(count: int) -> list[dict]:
+    return [
+        {
+            'update_id': i,
+            'message': {
+                'message_id': i,
+                'date': 1662379200,
+                'chat': {'id': i, 'type': 'private'},
+                'from': {'id': i, 'is_bot': False, 'first_name': f'user{i}'},
+                'text': '/start',
+            },
+        } for i in range(count)
+    ]
+
+
+class TestWebhookServer(TestCase):
+    def run_server(self, queue_size: int, client_kwargs: dict, updates: list[dict]):
+        async def run():
+            queue = asyncio.Queue(maxsize=queue_size)
+            server = WebhookServer(queue, Bot('123:test'), port=0, secret_token='secret')
+            await server.start()
+            try:
+                client = WebhookClient(server.port, **client_kwargs)
+                statuses = await client.replay(updates)
+            finally:
+                await server.stop()
+            return server, queue, statuses
+        return asyncio.run(run())
+
+    def test_replay_into_bounded_queue(self):
+        server, queue, statuses = self.run_server(
+            2, {'secret_token': 'secret'}, build_updates(3))
+        assert statuses == [200, 200, 503]  # queue full, Telegram will retry
+        assert queue.get_nowait().message.text == '/start'
+        assert server.stats['received'] == 2 and server.stats['dropped'] == 1
+
+    def test_secret_token_and_path_checked(self):
+        server, queue, statuses = self.run_server(
+            10, {'secret_token': 'wrong'}, build_updates(1))
+        assert statuses == [403]
+        server, queue, statuses = self.run_server(
+            10, {'secret_token': 'secret', 'url_path': 'other'}, build_updates(1))
+        assert statuses == [404]
+        assert queue.empty() and server.stats['rejected'] == 1
+        server, queue, statuses = self.run_server(10, {}, build_updates(1))
+        assert statuses == [403]  # no header at all
+        with self.assertRaises(ValueError):
+            WebhookServer(asyncio.Queue(), Bot('123:test'))
+
+    def test_slow_and_malformed_requests(self):
+        async def run():
+            queue = asyncio.Queue()
+            server = WebhookServer(
+                queue, Bot('123:test'), port=0, secret_token='secret', read_timeout=0.1)
+            await server.start()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                writer.write(b'POST /telegram HTTP/1.1\r\nContent-Length: 10\r\n')  # stalls
+                await writer.drain()
+                slow = await reader.readline()
+                writer.close()
+                client = WebhookClient(server.port, secret_token='secret')
+                malformed = await client.replay([{'update_id': 1, 'message': 5}, [1]])
+            finally:
+                await server.stop()
+            return slow, malformed, queue
+
+        slow, malformed, queue = asyncio.run(run())
+        assert slow.startswith(b'HTTP/1.1 408')
+        assert malformed == [400, 400]  # JSON, but not an Update
+        assert queue.empty()
+
+    def test_connection_reset_closes_socket(self):
+        server = WebhookServer(asyncio.Queue(), Bot('123:test'), secret_token='secret')
+        reader = MagicMock(readline=AsyncMock(side_effect=ConnectionResetError))
+        writer = MagicMock(drain=AsyncMock())
+        asyncio.run(server.handle(reader, writer))
+        writer.write.assert_not_called()  # nobody to answer
+        writer.close.assert_called_once()
+
+    def test_telegram_bot_webhook_mode(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'TELEGRAM': {'manager_password': '1234'},
+            'WEBHOOK': {'enabled': 'true', 'port': '0', 'queue_size': '5'},
+        })
+        with self.assertRaises(ValueError):  # no secret_token
+            TelegramBot('123:test', config=config)
+        config['WEBHOOK']['secret_token'] = 'secret'
+        telegram_bot = TelegramBot('123:test', config=config)
+        assert telegram_bot.webhook.update_queue is telegram_bot.application.update_queue
+        assert telegram_bot.application.update_queue.maxsize == 5
+        config.remove_section('WEBHOOK')
+        assert TelegramBot('123:test', config=config).webhook is None
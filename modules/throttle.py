@@ -0,0 +1,45 @@
+from telegram import Update
+
+from .cache import LRUCache
+from .sender import TokenBucket
+
+
+class UpdateThrottle:
+    """Ограничение частоты обновлений от одного пользователя: token bucket на uid
+       Проверяется в UserSerialApplication до очереди пользователя, поэтому лишние
+       обновления не ждут своей очереди и не доходят до обработчиков и базы
+       Бакеты хранятся в LRUCache: неактивные пользователи вытесняются по TTL и размеру
+    """
+
+    def __init__(self, rate: float = 1, capacity: float = 5, maxsize=100_000, ttl: float = 600):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.passed = 0
+        self.dropped = 0
+
+    def allow(self, uid: int) -> bool:
+        """Взять токен пользователя; False - обновление нужно отбросить"""
+        bucket = self.buckets.get(uid)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.capacity)
+        self.buckets.set(uid, bucket)  # продлить TTL активного пользователя
+        if bucket.try_acquire():
+            self.dropped += 1
+            return False
+        self.passed += 1
+        return True
+
+    @staticmethod
+    async def reject(update: object) -> None:
+        """Ответить на отброшенный callback query, иначе у кнопки висит индикатор загрузки"""
+        if isinstance(update, Update) and update.callback_query:
+            await update.callback_query.answer()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'users': len(self.buckets),
+            'passed': self.passed,
+            'dropped': self.dropped,
+        }
@@ -1,15 +1,17 @@
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from datetime import datetime
 
 
-class UserRole(Enum):
+class UserRole(str, Enum):
     USER = 'Пользователь'
     MANAGER = 'Менеджер'
 
 
 @dataclass
 class User:
+    __slots__ = (
+        'uid', 'username', 'first_name', 'full_name', 'phone_num', 'role', 'created', 'updated')
     uid: int
     username: str
     first_name: str
@@ -19,12 +21,30 @@ class User:
     created: str
     updated: str
 
+    @classmethod
+    def field_names(cls) -> tuple[str, ...]:
+        return tuple(field.name for field in fields(cls))
+
+    def to_row(self) -> tuple:
+        """Значения полей для записи в базу данных (роль как строка)"""
+        return tuple(
+            value.value if isinstance(value, UserRole) else value
+            for value in (getattr(self, name) for name in self.__slots__)
+        )
+
+
+def user_row_factory(cursor, row) -> User:
+    """sqlite3 row_factory: строка таблицы users -> User"""
+    uid, username, first_name, full_name, phone_num, role, created, updated = row
+    return User(
+        uid, username, first_name, full_name, phone_num, UserRole(role), created, updated)
+
 
 def build_user(user_data: dict, tg_data: dict, manager=False) -> User:
     """user_data - из json файла; tg_data - объект телеграм пользователя"""
     now = str(datetime.now())
     username = tg_data['username'] if tg_data['username'] else tg_data['first_name']
-    user_role = UserRole.MANAGER.value if manager else UserRole.USER.value
+    user_role = UserRole.MANAGER if manager else UserRole.USER
     user = User(
         tg_data['id'],
         username,
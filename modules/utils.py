@@ -3,9 +3,14 @@ import codecs
 import gspread
 import traceback
 import json
+import logging
+import os
 import re
+import tempfile
 
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import NamedTuple, Optional
 
 
 def build_config(config_name='config.ini') -> None:
@@ -19,6 +24,21 @@ def build_config(config_name='config.ini') -> None:
             'api_token': '',
             'developer_id': '',
             'manager_password': 1234,
+            'review_digest': False,
+            'review_digest_size': 20,
+            'review_digest_interval': 3600,
+            'concurrent_updates': 64,
+            'throttle_rate': 1,
+            'throttle_capacity': 5,
+        },
+        'WEBHOOK': {
+            'enabled': False,
+            'listen': '127.0.0.1',
+            'port': 8443,
+            'url_path': 'telegram',
+            'webhook_url': '',
+            'secret_token': '',
+            'queue_size': 1000,
         },
     })
     with open(config_name, 'w') as f:
@@ -58,6 +78,24 @@ def update_json_file(data, file_path, mode='w'):
         json.dump(data, json_file, indent=4)
 
 
+def replace_json_file(data, file_path):
+    """Atomically replace `file_path`: write a temp file in the same dir, then os.replace
+       Readers and a crash mid-write never see a partially written file
+    """
+    dir_name = os.path.dirname(os.path.abspath(file_path))
+    with tempfile.NamedTemporaryFile(
+            'w', encoding='UTF-8', dir=dir_name, suffix='.tmp', delete=False) as json_file:
+        try:
+            json.dump(data, json_file, indent=4)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        except BaseException:
+            json_file.close()
+            os.remove(json_file.name)
+            raise
+    os.replace(json_file.name, file_path)
+
+
 def get_datetime_passed_seconds(
         time_stamp, date_fmt='%Y-%m-%d %H:%M:%S', time_now=None, reverse=False):
     time_now = time_now if time_now else datetime.now()
@@ -70,33 +108,90 @@ def get_datetime_passed_seconds(
     return int(time_passed.total_seconds())
 
 
+SHEET_DAYS = {
+    'ежедневно': range(0, 7),
+    'будние': range(0, 5),
+    'понедельник': 0,
+    'вторник': 1,
+    'среда': 2,
+    'четверг': 3,
+    'пятница': 4,
+    'суббота': 5,
+    'воскресенье': 6,
+}
+SHEET_TIME_RE = re.compile(r'(\d+):(\d+)')
+
+
+class WeeklySchedule(NamedTuple):
+    """Недельное расписание: битовая маска дней (бит 0 - понедельник) и минута дня"""
+    days: int
+    minutes: int
+
+    def job_at(self, day: date) -> Optional[str]:
+        """Время задачи в формате `%Y-%m-%d %H:%M:%S`, если в `day` есть уборка"""
+        if not self.days & (1 << day.weekday()):
+            return None
+        return f'{day} {self.minutes // 60:02d}:{self.minutes % 60:02d}:00'
+
+
 def slice_sheet_dates(date: str) -> tuple[list[int], str]:
     """Отформатировать строку слов/времени к datetime формату"""
-    sheet_days = {
-        'ежедневно': range(0, 7),
-        'будние': range(0, 5),
-        'понедельник': 0,
-        'вторник': 1,
-        'среда': 2,
-        'четверг': 3,
-        'пятница': 4,
-        'суббота': 5,
-        'воскресенье': 6,
-    }
     days = []
-    for day in sheet_days:
-        if day in date.lower():
+    date_lower = date.lower()
+    for day in SHEET_DAYS:
+        if day in date_lower:
             try:
-                days += sheet_days[day]
+                days += SHEET_DAYS[day]
             except TypeError:
-                days.append(sheet_days[day])
-    sheet_time = re.search(r'\d+:\d+', date)[0]
+                days.append(SHEET_DAYS[day])
+    sheet_time = SHEET_TIME_RE.search(date)[0]
     return (days, sheet_time)
 
 
-def format_cleaning_date(date: tuple[list[int], str]) -> str:
+@lru_cache(maxsize=4096)
+def compile_clean_time(clean_time: str) -> Optional[WeeklySchedule]:
+    """Скомпилировать строку `clean_time` из таблицы в WeeklySchedule
+       Результат кэшируется по исходной строке; None - время не найдено или неверное
+    """
+    date_lower = clean_time.lower()
+    days = 0
+    for day, weekdays in SHEET_DAYS.items():
+        if day in date_lower:
+            for weekday in (weekdays if isinstance(weekdays, range) else [weekdays]):
+                days |= 1 << weekday
+    sheet_time = SHEET_TIME_RE.search(clean_time)
+    if not sheet_time:
+        return None
+    hour, minute = int(sheet_time[1]), int(sheet_time[2])
+    if hour > 23 or minute > 59:
+        logging.warning(f'Invalid clean time {clean_time!r}, skipped')
+        return None
+    return WeeklySchedule(days, hour * 60 + minute)
+
+
+def week_due_times(
+        schedules: list[Optional[WeeklySchedule]], start: date, days=7) -> list[list[datetime]]:
+    """Время уборок на `days` дней вперед от `start` для каждого расписания
+       Одинаковые расписания рассчитываются один раз
+    """
+    week = [start + timedelta(days=i) for i in range(days)]
+    week = [(datetime.combine(day, time()), 1 << day.weekday()) for day in week]
+    due_times = {None: []}
+    result = []
+    for schedule in schedules:
+        times = due_times.get(schedule)
+        if times is None:
+            times = due_times[schedule] = [
+                day + timedelta(minutes=schedule.minutes)
+                for day, weekday in week if schedule.days & weekday
+            ]
+        result.append(times)
+    return result
+
+
+def format_cleaning_date(date: tuple[list[int], str], today: datetime = None) -> str:
     """Найти есть ли сегодня уборка; Перевести дни и время в datetime формат"""
-    today = datetime.today()
+    today = today if today else datetime.today()
     for day in date[0]:
         if day != today.weekday():
             continue
@@ -0,0 +1,142 @@
+import asyncio
+import hmac
+import json
+import logging
+
+from typing import Iterable
+
+from telegram import Update
+
+
+class WebhookServer:
+    """Прием обновлений Telegram по HTTP (webhook) на asyncio, без сторонних зависимостей
+       POST на `url_path` с заголовком X-Telegram-Bot-Api-Secret-Token = `secret_token`
+       (без секрета сервер не запускается); запрос должен прийти целиком за `read_timeout`
+       Обновления кладутся в ограниченную `update_queue` приложения; при переполнении
+       отвечаем 503 и Telegram повторит доставку позже
+    """
+    secret_header = 'x-telegram-bot-api-secret-token'
+    reasons = {
+        200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+        408: 'Request Timeout', 413: 'Payload Too Large', 503: 'Service Unavailable',
+    }
+
+    def __init__(
+            self, update_queue: asyncio.Queue, bot, listen='127.0.0.1', port=8443,
+            url_path='telegram', secret_token='', max_body=1024 * 1024, read_timeout=10):
+        if not secret_token:
+            raise ValueError('Webhook mode requires a secret_token')
+        self.update_queue = update_queue
+        self.bot = bot
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self.server = None
+        self.received = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]  # port=0 - any free port
+        logging.info(f'Webhook listening on {self.listen}:{self.port}{self.url_path}')
+
+    async def stop(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        logging.info('Webhook stopped: %s', self.stats)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                status = await asyncio.wait_for(self.process(reader), self.read_timeout)
+            except asyncio.TimeoutError:
+                status = 408
+            except (asyncio.IncompleteReadError, UnicodeDecodeError, ValueError):
+                status = 400
+            if status in (403, 404, 408):
+                self.rejected += 1
+            writer.write(
+                f'HTTP/1.1 {status} {self.reasons[status]}\r\n'
+                'Content-Length: 0\r\nConnection: close\r\n\r\n'.encode('latin-1'))
+            await writer.drain()
+        except OSError as e:  # client went away, nobody to reply to
+            logging.debug(f'Webhook connection lost: {e!r}')
+        finally:
+            writer.close()
+
+    async def process(self, reader: asyncio.StreamReader) -> int:
+        """Разобрать один HTTP запрос и вернуть код ответа"""
+        method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if method != 'POST' or path.rstrip('/') != self.url_path:
+            return 404
+        if not hmac.compare_digest(headers.get(self.secret_header, ''), self.secret_token):
+            return 403
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            return 413
+        data = json.loads(await reader.readexactly(length))
+        try:
+            update = Update.de_json(data, self.bot)
+        except (TypeError, AttributeError, KeyError):
+            return 400  # valid JSON, but not an Update
+        try:
+            self.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return 503
+        self.received += 1
+        return 200
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'queued': self.update_queue.qsize(),
+        }
+
+
+class WebhookClient:
+    """Локальная замена Telegram для тестов: отправляет обновления в WebhookServer"""
+
+    def __init__(self, port: int, host='127.0.0.1', url_path='telegram', secret_token=''):
+        self.host = host
+        self.port = port
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+
+    async def post(self, update: dict) -> int:
+        """Отправить одно обновление, вернуть HTTP код ответа"""
+        body = json.dumps(update).encode('utf-8')
+        headers = [
+            f'POST {self.url_path} HTTP/1.1',
+            f'Host: {self.host}:{self.port}',
+            'Content-Type: application/json',
+            f'Content-Length: {len(body)}',
+        ]
+        if self.secret_token:
+            headers.append(f'X-Telegram-Bot-Api-Secret-Token: {self.secret_token}')
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write('\r\n'.join(headers).encode('latin-1') + b'\r\n\r\n' + body)
+            await writer.drain()
+            status_line = await reader.readline()
+        finally:
+            writer.close()
+            await writer.wait_closed()
+        return int(status_line.split()[1])
+
+    async def replay(self, updates: Iterable[dict]) -> list[int]:
+        """Отправить поток обновлений по порядку, как это делает Telegram"""
+        return [await self.post(update) for update in updates]